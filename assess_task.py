@@ -1,6 +1,9 @@
+from array import array
+import ast
 import concurrent.futures
 import csv
 import glob
+import hashlib
 import json
 import os.path
 import tkinter as tk
@@ -9,80 +12,75 @@ from tkinter import ttk
 from tkinter.filedialog import asksaveasfile
 
 import Levenshtein
+import numpy as np
 import pandas as pd
 from anytree import RenderTree, Node
 from tqdm import tqdm
 
-from cf import get_params, get_paths, get_project
+from cf import get_params, get_paths, get_project, get_timestamp, is_reference, project_hash
+from project_store import get_projects_files, get_student_file, load_projects
+from pq_grams import load_index as load_pq_gram_index
+from text_index import load_index
+from tree_cache import TreeCache, params_hash, tree_key, DEFAULT_CACHE_SIZE
+
+
+CATEGORIES = ("Motors", "Movement", "Light", "Sound", "Events", "Control", "Sensors", "Operators", "Variables",
+              "My Blocks")
+
+# Keywords of the opcode prefixes, checked in order.
+CATEGORY_KEYWORDS = {"motor": "Motors",
+                     "move": "Movement",
+                     "display": "Light",
+                     "light": "Light",
+                     "sound": "Sound",
+                     "event": "Events",
+                     "control": "Control",
+                     "sensors": "Sensors",
+                     "operator": "Operators",
+                     "data": "Variables",
+                     "procedures": "My Blocks"}
+
+# Key: value
+# opcode: category, filled as the opcodes are met.
+opcode_categories = dict()
+
+
+def opcode_category(opcode):
+    category = opcode_categories.get(opcode, None)
+    if category is None:
+        opcode_start = opcode.split("_")[0]
+        for keyw, keyw_category in CATEGORY_KEYWORDS.items():
+            if keyw in opcode_start:
+                category = keyw_category
+                break
+        else:
+            raise Exception(f"Error categorizing block {opcode_start} ({opcode}).")
+        opcode_categories[opcode] = category
+    return category
 
 
 def block_classifier(blocks, block_parts):
     # Sorts blocks into categories.
 
-    keyword = {"Motors": 0,
-               "Movement": 0,
-               "Light": 0,
-               "Sound": 0,
-               "Events": 0,
-               "Control": 0,
-               "Sensors": 0,
-               "Operators": 0,
-               "Variables": 0,
-               "My Blocks": 0}
-
-    inv_keyword = {"motor": "Motors",
-                   "move": "Movement",
-                   "display": "Light",
-                   "light": "Light",
-                   "sound": "Sound",
-                   "event": "Events",
-                   "control": "Control",
-                   "sensors": "Sensors",
-                   "operator": "Operators",
-                   "data": "Variables",
-                   "procedures": "My Blocks"}
+    keyword = dict.fromkeys(CATEGORIES, 0)
 
     primary_keys = set(blocks.keys())
-    secondary_keys = set()
-
     for sublist in block_parts.values():
-        for item in sublist:
-            secondary_keys.add(item)
-
-    primary_keys -= secondary_keys
+        primary_keys.difference_update(sublist)
 
     for primary_key in primary_keys:
-        opcode = blocks[primary_key]["opcode"]
-        opcode_start = opcode.split("_")[0]
-
-        check = True
-        for keyw in inv_keyword.keys():
-            if keyw in opcode_start:
-                keyword[inv_keyword[keyw]] += 1
-                check = False
-                break
-        if check:
-            raise Exception(f"Error categorizing block {opcode_start} ({opcode}).")
+        keyword[opcode_category(blocks[primary_key]["opcode"])] += 1
 
         condition = blocks[primary_key].get("condition", None)
         if condition:
-            condition_opcode = blocks[condition]["opcode"]
-            condition_opcode_start = condition_opcode.split("_")[0]
-
-            check = True
-            for keyw in inv_keyword.keys():
-                if keyw in condition_opcode_start:
-                    keyword[inv_keyword[keyw]] += 1
-                    check = False
-                    break
-            if check:
-                raise Exception(f"Error categorizing block {condition_opcode_start} ({condition_opcode}).")
+            keyword[opcode_category(blocks[condition]["opcode"])] += 1
 
     return keyword
 
 
-def tree_builder_fast(blocks, cleanup=False, onlykeep=None):
-    # Builds a tree equivalent of the graphical solution.
+def tree_layout(blocks, cleanup=False, onlykeep=None):
+    # Collects the primary blocks, their parts, the sorted roots and the substacks,
+    # from which the tree builders create the tree.
 
     # Set of all block keys (unique).
     all_keys = set(blocks.keys())
@@ -153,6 +151,15 @@ def tree_builder_fast(blocks, cleanup=False, onlykeep=None):
     else:
         sorted_roots = list(roots.keys())
 
+    return onlykeep_keys, primary_keys, block_parts, sorted_roots, substacks, substacks2
+
+
+def tree_builder_fast(blocks, cleanup=False, onlykeep=None):
+    # Builds a tree equivalent of the graphical solution.
+
+    onlykeep_keys, primary_keys, block_parts, sorted_roots, substacks, substacks2 = tree_layout(blocks, cleanup,
+                                                                                                onlykeep)
+
     # Create tree
 
     tree = dict()
@@ -221,6 +228,138 @@ def tree_visualizer(blocks, block_parts, tree, flexible):
     return tree_str
 
 
+class ArrayTree:
+    # Compact tree of block keys used instead of anytree nodes in the hot path.
+    # Nodes are indices, node 0 is the root and the links are stored in arrays (-1 if none).
+    # While building, children are kept in lists and assigned with the semantics of anytree,
+    # i.e. a node attached to a new parent is detached from the previous one.
+    def __init__(self, _keys):
+        self.keys = ["root"] + list(_keys)
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.parent = [-1] * len(self.keys)
+        self.children_lists = [[] for _ in self.keys]
+        self.first_child = None
+        self.next_sibling = None
+
+    def set_children(self, node, children):
+        if len(set(children)) != len(children):
+            raise Exception(f"Cannot add node {self.keys[node]} multiple times.")
+        for child in self.children_lists[node]:
+            self.parent[child] = -1
+        self.children_lists[node] = []
+        for child in children:
+            ancestor = node
+            while ancestor != -1:
+                if ancestor == child:
+                    raise Exception(f"Cannot set parent of {self.keys[child]}, it would create a loop.")
+                ancestor = self.parent[ancestor]
+            previous_parent = self.parent[child]
+            if previous_parent != -1:
+                self.children_lists[previous_parent].remove(child)
+            self.parent[child] = node
+            self.children_lists[node].append(child)
+
+    def finalize(self):
+        # Converts the children lists into first child and next sibling arrays.
+        size = len(self.keys)
+        self.first_child = array('i', [-1]) * size
+        self.next_sibling = array('i', [-1]) * size
+        for node, children in enumerate(self.children_lists):
+            if children:
+                self.first_child[node] = children[0]
+                for child, next_child in zip(children, children[1:]):
+                    self.next_sibling[child] = next_child
+        self.parent = array('i', self.parent)
+        self.children_lists = None
+
+    def children(self, node):
+        child = self.first_child[node]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def count_children(self, node):
+        return sum(1 for _ in self.children(node))
+
+
+def tree_builder_array(blocks, cleanup=False, onlykeep=None):
+    # Builds the same tree as tree_builder_fast, stored as an ArrayTree.
+
+    onlykeep_keys, primary_keys, block_parts, sorted_roots, substacks, substacks2 = tree_layout(blocks, cleanup,
+                                                                                                onlykeep)
+
+    tree = ArrayTree(primary_keys)
+    index = tree.index
+    tree.set_children(0, [index[root] for root in sorted_roots])
+
+    def stack_nodes(first_key, s_children):
+        # Appends the kept blocks of the stack starting with first_key.
+        if first_key in onlykeep_keys:
+            s_children.append(index[first_key])
+        nxt = blocks[first_key].get("next", None)
+        while nxt:
+            if nxt in onlykeep_keys:
+                s_children.append(index[nxt])
+            nxt = blocks[nxt].get("next", None)
+        return s_children
+
+    for key, value in substacks.items():
+        if value:
+            tree.set_children(index[key], stack_nodes(value, list()))
+
+    for key, value in substacks2.items():
+        if value:
+            tree.set_children(index[key], stack_nodes(value, list(tree.children_lists[index[key]])))
+
+    for root in sorted_roots:
+        r_children = list()
+        nxt = blocks[root].get("next", None)
+        while nxt:
+            if nxt in onlykeep_keys:
+                r_children.append(index[nxt])
+            nxt = blocks[nxt].get("next", None)
+        tree.set_children(index[root], r_children)
+
+    tree.finalize()
+    return tree, block_parts
+
+
+def tree_visualizer_array(blocks, block_parts, tree, flexible):
+    # Converts an ArrayTree to plain text, identical to tree_visualizer.
+    # The tree is walked iteratively and the lines are joined at once.
+
+    lines = ["\n", "root\n"]
+    log_sup = block_params(blocks, flexible)
+    keys = tree.keys
+    first_child = tree.first_child
+    next_sibling = tree.next_sibling
+    # Nodes to visit with the indentation of their level.
+    stack = [(first_child[0], "")]
+    while stack:
+        node, indent = stack.pop()
+        if node == -1:
+            continue
+        sibling = next_sibling[node]
+        is_last = sibling == -1
+        if not is_last:
+            stack.append((sibling, indent))
+        key = keys[node]
+        line = [f"{indent}{'└── ' if is_last else '├── '}{blocks[key]['opcode']}{log_sup[key]}"]
+        if key in block_parts:
+            for part in block_parts[key]:
+                line.append(f" | {blocks[part]['opcode']}{log_sup[part]}")
+                if part in block_parts:
+                    for subpart in block_parts[part]:
+                        line.append(f" | {blocks[subpart]['opcode']}{log_sup[subpart]}")
+        line.append("\n")
+        lines.append("".join(line))
+        child = first_child[node]
+        if child != -1:
+            stack.append((child, f"{indent}{'    ' if is_last else '│   '}"))
+
+    return "".join(lines)
+
+
 def block_params(blocks, flexible):
     # Filters block parameters by removing unused_attributes,
     # block keys and all non-string values.
@@ -255,14 +394,63 @@ def get_distinct_blocks(blocks):
     return set(opcodes)
 
 
+def create_student_trees(student_files, cleanup, onlykeep, flexible, parameters_hash, cache=None):
+    # Creates the textual trees of all snapshots of a student.
+
+    student_trees = dict()
+    for student_file_name, student_file_content in student_files.items():
+        if is_reference(student_file_content):
+            continue
+        blocks = student_file_content["blocks"]
+        tree_str = None
+        if cache:
+            key = tree_key(blocks, parameters_hash)
+            tree_str = cache.get(key)
+        if tree_str is None:
+            tree, block_parts = tree_builder_array(blocks, cleanup, onlykeep)
+            tree_str = tree_visualizer_array(blocks, block_parts, tree, flexible)
+            if cache:
+                cache.put(key, tree_str)
+        student_trees[student_file_name] = tree_str
+
+    # Deduplicated snapshots reuse the tree of the identical snapshot.
+    for student_file_name in student_files:
+        ref_file_name = student_file_name
+        while is_reference(student_files[ref_file_name]):
+            ref_file_name = student_files[ref_file_name]["ref"]
+        if ref_file_name != student_file_name:
+            student_trees[student_file_name] = student_trees[ref_file_name]
+
+    return student_trees
+
+
+def create_tree_file(input_file, out_file, cleanup, onlykeep, flexible, parameters_hash, cache_file, cache_size):
+    # Creates and saves the trees of a student in a worker process.
+    # Returns the tree cache hits, misses and updates, the cache is only read by the workers.
+
+    student_files = load_projects(input_file, resolve=False)
+    cache = TreeCache(cache_file, cache_size) if cache_file else None
+    student_trees = create_student_trees(student_files, cleanup, onlykeep, flexible, parameters_hash, cache)
+    TreeBuilder.save_output_file(out_file, student_trees)
+    if cache:
+        updates = cache.take_updates()
+        cache.close()
+        return cache.hits, cache.misses, updates
+    return 0, 0, (list(), list())
+
+
 class TreeBuilder:
     # Loads parsed project json files and creates textual trees.
     # Results are saved as json files named after the loaded files.
-    def __init__(self, _path, _out_folder_name, _path_params=None):
+    # If cache_file is given, trees are reused from the persistent tree cache.
+    # If processes is set, each student's trees are created and saved by a worker process,
+    # otherwise all the trees are created in a thread pool and saved at the end.
+    def __init__(self, _path, _out_folder_name, _path_params=None, _cache_file=None, _cache_size=DEFAULT_CACHE_SIZE,
+                 _processes=False, _max_workers=None):
         self.path_params = _path_params
         self.out_folder_name = _out_folder_name
         self.path = _path
-        self.input_files = glob.glob(f'{self.path}/*.json')
+        self.input_files = get_projects_files(self.path)
         self.out_folder = os.path.normpath(self.out_folder_name)
         if not os.path.isdir(self.out_folder):
             os.makedirs(self.out_folder)
@@ -270,6 +458,13 @@ class TreeBuilder:
         self.onlykeep = None
         self.flexible = None
         self.get_parameters()
+        self.cache_file = _cache_file
+        self.cache_size = _cache_size
+        self.params_hash = params_hash(self.cleanup, self.onlykeep, self.flexible)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.processes = _processes
+        self.max_workers = _max_workers
 
     def get_parameters(self):
         if os.path.isfile(self.path_params):
@@ -282,57 +477,466 @@ class TreeBuilder:
                 print(f"Error reading parameters:\n{e}\n")
 
     def create_tree_from_file(self, input_file, out_file, folder_files):
+        # Returns the tree cache hits, misses and updates, which are written by the main thread.
 
-        folder_files[out_file] = dict()
+        student_files = load_projects(input_file, resolve=False)
+        cache = TreeCache(self.cache_file, self.cache_size) if self.cache_file else None
+        folder_files[out_file] = create_student_trees(student_files, self.cleanup, self.onlykeep, self.flexible,
+                                                      self.params_hash, cache)
 
-        with open(input_file, 'r', encoding='utf-8') as f:
-            student_files = json.load(f)
+        if cache:
+            updates = cache.take_updates()
+            cache.close()
+            return cache.hits, cache.misses, updates
+        return 0, 0, (list(), list())
 
-        for student_file_name, student_file_content in student_files.items():
-            blocks = student_file_content["blocks"]
-            tree, block_parts = tree_builder_fast(blocks, self.cleanup, self.onlykeep)
-            tree_str = tree_visualizer(blocks, block_parts, tree, self.flexible)
-            folder_files[out_file][student_file_name] = tree_str
+    def get_out_file(self, input_file):
+        return f"{self.out_folder}/{os.path.splitext(os.path.basename(input_file))[0]}.json"
 
     def create_trees(self):
+        if self.processes:
+            self.create_trees_processes()
+            return
+
         folder_files = dict()
+        cache = TreeCache(self.cache_file, self.cache_size) if self.cache_file else None
 
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self.create_tree_from_file, input_file,
-                                       f"{self.out_folder}/{os.path.basename(input_file)}", folder_files)
-                       for input_file in self.input_files]
-            for _ in tqdm(concurrent.futures.as_completed(futures), total=len(futures),
-                          bar_format='Creating trees:  {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
-                pass
+            future_to_file = {executor.submit(self.create_tree_from_file, input_file, self.get_out_file(input_file),
+                                              folder_files): input_file
+                              for input_file in self.input_files}
+            for future in tqdm(concurrent.futures.as_completed(future_to_file), total=len(future_to_file),
+                               bar_format='Creating trees:  {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
+                try:
+                    hits, misses, updates = future.result()
+                    self.add_cache_updates(cache, hits, misses, updates)
+                except Exception as exc:
+                    print(f'{future_to_file[future]} generated an exception: {exc}')
 
         self.save_output(folder_files)
+        if cache:
+            self.print_cache_stats(cache)
+        print(f"\nTrees path: {self.out_folder}")
+
+    def add_cache_updates(self, cache, hits, misses, updates):
+        # The trees created by the workers are saved by a single connection, one student per transaction.
+        self.cache_hits += hits
+        self.cache_misses += misses
+        if cache:
+            cache.add_updates(*updates)
+            cache.commit()
+
+    def create_trees_processes(self):
+        # Workers save the trees themselves, so only one student per worker is kept in memory.
+        cache = TreeCache(self.cache_file, self.cache_size) if self.cache_file else None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_file = {executor.submit(create_tree_file, input_file, self.get_out_file(input_file),
+                                              self.cleanup, self.onlykeep, self.flexible, self.params_hash,
+                                              self.cache_file, self.cache_size): input_file
+                              for input_file in self.input_files}
+            for future in tqdm(concurrent.futures.as_completed(future_to_file), total=len(future_to_file),
+                               bar_format='Creating trees:  {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
+                try:
+                    hits, misses, updates = future.result()
+                    self.add_cache_updates(cache, hits, misses, updates)
+                except Exception as exc:
+                    print(f'{future_to_file[future]} generated an exception: {exc}')
+
+        if cache:
+            self.print_cache_stats(cache)
         print(f"\nTrees path: {self.out_folder}")
 
+    def print_cache_stats(self, cache):
+        evicted = cache.evict()
+        cache.close()
+        lookups = self.cache_hits + self.cache_misses
+        hit_rate = self.cache_hits / lookups * 100 if lookups else 0
+        print(f"\nTree cache: {self.cache_hits} of {lookups} trees reused ({hit_rate:.1f} %), {evicted} evicted.")
+
     def save_output(self, folder_files):
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(self._save_output_file, out_file, folder_files[out_file])
+            futures = [executor.submit(self.save_output_file, out_file, folder_files[out_file])
                        for out_file in folder_files]
             for _ in tqdm(concurrent.futures.as_completed(futures), total=len(futures),
                           bar_format='Saving results:  {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
                 pass
 
     @staticmethod
-    def _save_output_file(out_file, output_data):
+    def save_output_file(out_file, output_data):
         with open(out_file, 'w', encoding='utf-8') as f:
             json.dump(output_data, f, indent=2, sort_keys=True)
 
 
+BEYOND_THRESHOLD = "Beyond threshold"
+
+METRIC_CHARACTERS = "characters"
+METRIC_TOKENS = "tokens"
+
+
+def text_hash(text):
+    if not isinstance(text, str):
+        # Token sequence
+        return hashlib.blake2b(array('i', text).tobytes(), digest_size=16).digest()
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class TextTokenizer:
+    # Converts the textual trees into sequences of integer tokens, one token for each block at its depth
+    # and for each parameter value, so the distance counts the blocks and parameters that differ
+    # instead of the characters. Tokens are only comparable within the same tokenizer.
+    def __init__(self):
+        self.tokens = dict()
+        self.lines = dict()
+
+    def intern(self, token):
+        token_id = self.tokens.get(token, None)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.tokens[token] = token_id
+        return token_id
+
+    def tokenize_line(self, line):
+        # Each tree level is indented by 4 characters, including the branch of the node.
+        content = line.lstrip("│├└─ ")
+        depth = (len(line) - len(content)) // 4
+        line_tokens = list()
+        for i, item in enumerate(content.split(" | ")):
+            params_start = item.find("[")
+            if params_start == -1:
+                opcode, params = item, list()
+            else:
+                opcode = item[:params_start]
+                try:
+                    params = ast.literal_eval(item[params_start:])
+                except (ValueError, SyntaxError):
+                    params = [item[params_start:]]
+            # The first block of a line is a node of the tree, the rest are its parts.
+            line_tokens.append(self.intern(("block", depth, opcode) if i == 0 else ("part", opcode)))
+            line_tokens.extend(self.intern(("param", str(param))) for param in params)
+        return line_tokens
+
+    def tokenize(self, text):
+        text_tokens = list()
+        for line in text.split("\n"):
+            if not line:
+                continue
+            line_tokens = self.lines.get(line, None)
+            if line_tokens is None:
+                line_tokens = self.tokenize_line(line)
+                self.lines[line] = line_tokens
+            text_tokens.extend(line_tokens)
+        return tuple(text_tokens)
+
+    def tokenize_texts(self, texts):
+        return {file_name: self.tokenize(text) for file_name, text in texts.items()}
+
+
+class DistanceCache:
+    # Ratios and distances between the tree texts and the ground truth texts, keyed by the hashes of both texts,
+    # so each distinct tree text is compared to each ground truth example only once.
+    # Texts identical to a ground truth example are found by their hash without any comparison.
+    def __init__(self, _files_gt):
+        self.files_gt = [(name, text, text_hash(text)) for name, text in _files_gt.items()]
+        self.exact_gt = dict()
+        for name, _, gt_hash in reversed(self.files_gt):
+            self.exact_gt[gt_hash] = name
+        self.gt_lengths = set(len(text) for text in _files_gt.values())
+        self.ratios = dict()
+        # Distances computed with a cutoff are saved as lower bounds if they exceed it.
+        self.distances = dict()
+        self.hits = 0
+        self.misses = 0
+        self.exact_matches = 0
+
+    def ratio(self, key, text_gt, text_pr):
+        if key in self.ratios:
+            self.hits += 1
+            return self.ratios[key]
+        self.misses += 1
+        lr = Levenshtein.ratio(text_gt, text_pr)
+        self.ratios[key] = lr
+        return lr
+
+    def distance(self, key, text_gt, text_pr, cutoff=None):
+        # Returns a value larger than cutoff if the distance exceeds it.
+        if key in self.distances:
+            ld, exact = self.distances[key]
+            if exact or (cutoff is not None and ld > cutoff):
+                self.hits += 1
+                return ld
+        self.misses += 1
+        ld = Levenshtein.distance(text_gt, text_pr, score_cutoff=cutoff)
+        self.distances[key] = (ld, cutoff is None or ld <= cutoff)
+        return ld
+
+    def exact_match(self, student_texts):
+        # Returns the first snapshot identical to a ground truth example and the example.
+        for file_pr, text_pr in student_texts.items():
+            if len(text_pr) not in self.gt_lengths:
+                continue
+            gt_name = self.exact_gt.get(text_hash(text_pr), None)
+            if gt_name is not None:
+                self.exact_matches += 1
+                return file_pr, gt_name
+        return None
+
+    def stats(self):
+        return self.hits, self.misses, self.exact_matches
+
+
+class TimelineBounds:
+    # Lower bounds of the distances of a student's snapshots to the ground truth examples,
+    # following the student's timeline. By the triangle inequality,
+    # distance(example, snapshot) >= distance(example, previous snapshot) - distance(previous snapshot, snapshot),
+    # and consecutive snapshots mostly share a long prefix and suffix, which the distance of the snapshots skips,
+    # so the bounds cost in proportion to what changed. Pairs whose bound can't beat the best pair are skipped,
+    # so the results are identical to comparing every pair.
+    # If indel is set, the bounds are of the insertions and deletions distance used by the ratio.
+    def __init__(self, _cache, _indel=False):
+        self.gt_lengths = [len(file_gt_text) for _, file_gt_text, _ in _cache.files_gt]
+        self.indel = _indel
+        self.text = None
+        self.bounds = None
+        self.previous_text = None
+        self.previous_bounds = None
+        self.delta = None
+
+    def next_snapshot(self, text):
+        if self.text is not None:
+            self.previous_text, self.previous_bounds = self.text, self.bounds
+        self.text = text
+        # The length difference is a lower bound of both distances.
+        self.bounds = [abs(gt_length - len(text)) for gt_length in self.gt_lengths]
+        self.delta = None
+
+    def lower_bound(self, gt_index, needed):
+        # The distance of the snapshots is only computed if the bound could reach the needed value.
+        if (self.bounds[gt_index] >= needed or self.previous_bounds is None
+                or self.previous_bounds[gt_index] < needed):
+            return self.bounds[gt_index]
+        if self.delta is None:
+            if self.indel:
+                lengths = len(self.previous_text) + len(self.text)
+                ratio = Levenshtein.ratio(self.previous_text, self.text)
+                self.delta = round((1 - ratio) * lengths)
+            else:
+                # Larger distances can't give the needed bound for any example.
+                cutoff = max(self.previous_bounds) - needed
+                delta = Levenshtein.distance(self.previous_text, self.text, score_cutoff=cutoff)
+                self.delta = delta if delta <= cutoff else float("inf")
+        self.bounds[gt_index] = max(self.bounds[gt_index], self.previous_bounds[gt_index] - self.delta)
+        return self.bounds[gt_index]
+
+    def update(self, gt_index, distance):
+        # The distance is exact or a lower bound.
+        self.bounds[gt_index] = max(self.bounds[gt_index], distance)
+
+
+# Distance cache and maximum distance of a matching worker process, the ground truth is sent once.
+worker_cache = None
+worker_max_distance = None
+worker_tokenizer = None
+worker_first_hit = False
+
+
+def init_matching_worker(files_gt, max_distance=None, metric=METRIC_CHARACTERS, first_hit=False):
+    global worker_cache, worker_max_distance, worker_tokenizer, worker_first_hit
+    if metric == METRIC_TOKENS:
+        worker_tokenizer = TextTokenizer()
+        files_gt = worker_tokenizer.tokenize_texts(files_gt)
+    worker_cache = DistanceCache(files_gt)
+    worker_max_distance = max_distance
+    worker_first_hit = first_hit
+
+
+def get_student_name(student_file):
+    return os.path.basename(student_file).split(".")[0].split(" ")[-1]
+
+
+def nearest_snapshot(student_texts, cache):
+    # Returns the ratio, distance, ground truth file and snapshot file of the student's nearest snapshot.
+
+    exact_match = cache.exact_match(student_texts)
+    if exact_match:
+        file_pr, file_gt_name = exact_match
+        return [1.0, 0, file_gt_name, os.path.basename(file_pr)]
+
+    result = [0, 0, "", ""]
+    bounds = TimelineBounds(cache, _indel=True)
+    for file_pr, text_pr in student_texts.items():
+        pr_hash = text_hash(text_pr)
+        bounds.next_snapshot(text_pr)
+        for gt_index, (file_gt_name, file_gt_text, gt_hash) in enumerate(cache.files_gt):
+            lengths = len(file_gt_text) + len(text_pr)
+            # The ratio is 1 - indel distance / lengths.
+            if lengths and 1 - bounds.lower_bound(gt_index, (1 - result[0]) * lengths) / lengths <= result[0]:
+                continue
+            lr = cache.ratio((pr_hash, gt_hash), file_gt_text, text_pr)
+            bounds.update(gt_index, round((1 - lr) * lengths))
+            if lr > result[0]:
+                ld = cache.distance((pr_hash, gt_hash), file_gt_text, text_pr)
+                file_pr_short = os.path.basename(file_pr)
+                result = [lr, ld, file_gt_name, file_pr_short]
+    return result
+
+
+def nearest_snapshot_bounded(student_texts, cache, max_distance):
+    # Returns the snapshot with the smallest distance to a ground truth example,
+    # if the distance doesn't exceed max_distance, otherwise the student is beyond threshold.
+    # The length difference is a lower bound of the distance, so most pairs are skipped without computing it,
+    # and the computation of the others stops as soon as the distance exceeds the best distance so far.
+
+    exact_match = cache.exact_match(student_texts)
+    if exact_match:
+        file_pr, file_gt_name = exact_match
+        return [1.0, 0, file_gt_name, os.path.basename(file_pr)]
+
+    best = max_distance + 1
+    best_pair = None
+    bounds = TimelineBounds(cache)
+    for file_pr, text_pr in student_texts.items():
+        pr_hash = None
+        bounds.next_snapshot(text_pr)
+        for gt_index, (file_gt_name, file_gt_text, gt_hash) in enumerate(cache.files_gt):
+            if bounds.lower_bound(gt_index, best) >= best:
+                continue
+            if pr_hash is None:
+                pr_hash = text_hash(text_pr)
+            ld = cache.distance((pr_hash, gt_hash), file_gt_text, text_pr, cutoff=best - 1)
+            bounds.update(gt_index, ld)
+            if ld < best:
+                best = ld
+                best_pair = (file_gt_name, file_pr, file_gt_text, text_pr, pr_hash, gt_hash)
+
+    if best_pair is None:
+        return ["", "", BEYOND_THRESHOLD, ""]
+    file_gt_name, file_pr, file_gt_text, text_pr, pr_hash, gt_hash = best_pair
+    return [cache.ratio((pr_hash, gt_hash), file_gt_text, text_pr), best, file_gt_name, os.path.basename(file_pr)]
+
+
+def solution_time(file_names, file_pr):
+    # Seconds from the first snapshot of the student to the snapshot.
+    return round(get_timestamp(os.path.basename(file_pr)) - get_timestamp(os.path.basename(file_names[0])))
+
+
+def first_snapshot_bounded(student_texts, cache, max_distance):
+    # Returns the first snapshot in time within max_distance of a ground truth example
+    # with the nearest example and the seconds needed to reach it.
+    # The later snapshots are not compared at all.
+
+    file_names = sorted(student_texts.keys())
+    bounds = TimelineBounds(cache)
+    for file_pr in file_names:
+        text_pr = student_texts[file_pr]
+        pr_hash = None
+        best = max_distance + 1
+        best_gt = None
+        bounds.next_snapshot(text_pr)
+        for gt_index, (file_gt_name, file_gt_text, gt_hash) in enumerate(cache.files_gt):
+            if bounds.lower_bound(gt_index, best) >= best:
+                continue
+            if pr_hash is None:
+                pr_hash = text_hash(text_pr)
+            ld = cache.distance((pr_hash, gt_hash), file_gt_text, text_pr, cutoff=best - 1)
+            bounds.update(gt_index, ld)
+            if ld < best:
+                best = ld
+                best_gt = (file_gt_name, file_gt_text, gt_hash)
+        if best_gt:
+            file_gt_name, file_gt_text, gt_hash = best_gt
+            return [cache.ratio((pr_hash, gt_hash), file_gt_text, text_pr), best, file_gt_name,
+                    os.path.basename(file_pr), solution_time(file_names, file_pr)]
+
+    return ["", "", BEYOND_THRESHOLD, "", ""]
+
+
+def nearest_snapshot_indexed(student_texts, index, files_gt, gt_matches, first_hit=False):
+    # Same as nearest_snapshot_bounded (or first_snapshot_bounded if first_hit is set),
+    # with the distances within max_distance of each ground truth example found by a range query of the text index.
+
+    best = None
+    best_pair = None
+    file_names = sorted(student_texts.keys())
+    for file_pr in file_names:
+        text_pr = student_texts[file_pr]
+        text_id = index.ids[text_pr]
+        for (file_gt_name, file_gt_text), matches in zip(files_gt.items(), gt_matches):
+            ld = matches.get(text_id, None)
+            if ld is not None and (best is None or ld < best):
+                best = ld
+                best_pair = (file_gt_name, file_pr, file_gt_text, text_pr)
+        if first_hit and best_pair:
+            break
+
+    if best_pair is None:
+        return ["", "", BEYOND_THRESHOLD, ""] + ([""] if first_hit else [])
+    file_gt_name, file_pr, file_gt_text, text_pr = best_pair
+    result = [Levenshtein.ratio(file_gt_text, text_pr), best, file_gt_name, os.path.basename(file_pr)]
+    if first_hit:
+        result.append(solution_time(file_names, file_pr))
+    return result
+
+
+def match_student(student_texts, cache, max_distance=None, tokenizer=None, first_hit=False):
+    # The texts are compared as token sequences if a tokenizer is given.
+
+    if tokenizer:
+        student_texts = tokenizer.tokenize_texts(student_texts)
+    if max_distance is not None and first_hit:
+        return first_snapshot_bounded(student_texts, cache, max_distance)
+    if max_distance is not None:
+        return nearest_snapshot_bounded(student_texts, cache, max_distance)
+    return nearest_snapshot(student_texts, cache)
+
+
+def match_student_file(student_file):
+    # Finds the nearest snapshot of a student in a worker process.
+    # Returns the worker process ID for the progress of the workers and the cache statistics of the student.
+
+    with open(student_file, 'r', encoding='utf-8') as f:
+        student_texts = json.load(f)
+    stats = worker_cache.stats()
+    result = match_student(student_texts, worker_cache, worker_max_distance, worker_tokenizer, worker_first_hit)
+    stats = [after - before for before, after in zip(stats, worker_cache.stats())]
+    return os.getpid(), result, stats
+
+
 class TextMatching:
     # Evaluates each snapshots based on the Levenshtein distance from the ground truth examples.
     # Each student's nearest snapshot is saved in the "distances" table.
-    def __init__(self, _path_gt, _path_pr, _out_folder, _out_file):
+    # If processes is set, students are distributed among worker processes,
+    # which receive the ground truth once and load the trees of their students themselves.
+    # If max_distance is given, only the distances up to max_distance are computed,
+    # the nearest snapshot is the one with the smallest distance
+    # and the students without a snapshot within max_distance are marked as beyond threshold.
+    # If use_index is set as well, the trees within max_distance are found with the text index of the trees folder.
+    # The metric is either METRIC_CHARACTERS, the distance in characters,
+    # or METRIC_TOKENS, the distance in blocks and parameter values, which applies to max_distance as well.
+    # If structure is set, the table contains the largest pq-gram similarity of each student's snapshots
+    # to the ground truth examples as well.
+    # If first_hit is set with max_distance, the first snapshot within max_distance is saved instead of the nearest
+    # with the seconds from the student's first snapshot, and the later snapshots are not compared.
+    def __init__(self, _path_gt, _path_pr, _out_folder, _out_file, _processes=False, _max_workers=None,
+                 _max_distance=None, _use_index=False, _metric=METRIC_CHARACTERS, _structure=False,
+                 _first_hit=False):
         self.path_gt = _path_gt
         self.path_pr = _path_pr
         self.out_folder = os.path.normpath(_out_folder)
         self.out_file = os.path.normpath(_out_file)
+        self.processes = _processes
+        self.max_workers = _max_workers
+        self.max_distance = _max_distance
+        self.metric = _metric
+        # The text index measures the distance in characters.
+        self.use_index = _use_index and _max_distance is not None and _metric == METRIC_CHARACTERS
         self.files_gt = None
+        self.student_files = list()
         self.students = dict()
         self.results = dict()
+        self.cache_stats = [0, 0, 0]
+        self.structure = _structure
+        self.first_hit = _first_hit and _max_distance is not None
+        self.structure_scores = dict()
 
     def create_output_folder(self):
         if not os.path.isdir(self.out_folder):
@@ -347,39 +951,95 @@ class TextMatching:
     def load_project_files(self):
         if not os.path.exists(self.path_pr):
             raise Exception("Project path error")
-        for student_file in glob.glob(self.path_pr + r"/*.json"):
+        # Sorted, so the table doesn't depend on the order of the files in the folder.
+        self.student_files = sorted(glob.glob(self.path_pr + r"/*.json"))
+        if self.processes and not self.use_index:
+            return
+        for student_file in self.student_files:
             with open(student_file, 'r', encoding='utf-8') as f:
                 self.students[student_file] = json.load(f)
 
     def compare_texts(self):
-        for student_file in self.students:
-            student = os.path.basename(student_file).split(".")[0].split(" ")[-1]
-            self.results[student] = [0, 0, "", ""]
-        for student_file in tqdm(self.students.keys(), total=len(self.students),
+        if self.use_index:
+            self.compare_texts_index()
+            return
+        if self.processes:
+            self.compare_texts_processes()
+            return
+        tokenizer = TextTokenizer() if self.metric == METRIC_TOKENS else None
+        cache = DistanceCache(tokenizer.tokenize_texts(self.files_gt) if tokenizer else self.files_gt)
+        for student_file in tqdm(self.student_files, total=len(self.student_files),
                                  bar_format='Finding distance:  {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
-            student = os.path.basename(student_file).split(".")[0].split(" ")[-1]
-            for file_pr, text_pr in self.students[student_file].items():
-                for file_gt_name, file_gt_text in self.files_gt.items():
-                    lr = Levenshtein.ratio(file_gt_text, text_pr)
-                    if lr > self.results[student][0]:
-                        ld = Levenshtein.distance(file_gt_text, text_pr)
-                        file_pr_short = os.path.basename(file_pr)
-                        self.results[student] = [lr, ld, file_gt_name, file_pr_short]
-                    if lr == 1:
-                        break
+            student = get_student_name(student_file)
+            self.results[student] = match_student(self.students[student_file], cache, self.max_distance, tokenizer,
+                                                  self.first_hit)
+        self.cache_stats = list(cache.stats())
+
+    def compare_texts_index(self):
+        index = load_index(self.path_pr)
+        gt_matches = [index.range_query(file_gt_text, self.max_distance) for file_gt_text in self.files_gt.values()]
+        print(f"Text index: {index.comparisons} comparisons for {len(index)} distinct trees "
+              f"and {len(self.files_gt)} ground truth examples.")
+        for student_file in tqdm(self.student_files, total=len(self.student_files),
+                                 bar_format='Finding distance:  {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
+            student = get_student_name(student_file)
+            self.results[student] = nearest_snapshot_indexed(self.students[student_file], index, self.files_gt,
+                                                             gt_matches, self.first_hit)
+
+    def compare_texts_processes(self):
+        # Results are merged by student, so they don't depend on the order of completion.
+        worker_progress = dict()
+        initargs = (self.files_gt, self.max_distance, self.metric, self.first_hit)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_matching_worker,
+                                                    initargs=initargs) as executor:
+            future_to_file = {executor.submit(match_student_file, student_file): student_file
+                              for student_file in self.student_files}
+            progress = tqdm(concurrent.futures.as_completed(future_to_file), total=len(future_to_file),
+                            bar_format='Finding distance:  {l_bar}{bar}|  {n_fmt}/{total_fmt}{postfix}')
+            for future in progress:
+                student_file = future_to_file[future]
+                student = get_student_name(student_file)
+                try:
+                    worker, self.results[student], stats = future.result()
+                    self.cache_stats = [total + n for total, n in zip(self.cache_stats, stats)]
+                    worker_progress[worker] = worker_progress.get(worker, 0) + 1
+                    progress.set_postfix_str("Students per worker: "
+                                             + " ".join(str(n) for n in worker_progress.values()))
+                except Exception as exc:
+                    print(f'{student_file} generated an exception: {exc}')
+                    self.results[student] = [0, 0, "", ""] + ([""] if self.first_hit else [])
+
+    def compare_structure(self):
+        # All snapshots are ranked against each ground truth example in one pass over the pq-gram index.
+        index = load_pq_gram_index(self.path_pr)
+        similarities = [0] * len(index)
+        for file_gt_text in self.files_gt.values():
+            similarities = [max(similarity, 1 - distance)
+                            for similarity, distance in zip(similarities, index.distances(file_gt_text))]
+        for text_id, occurrences in index.occurrences.items():
+            for student_file, _ in occurrences:
+                student = get_student_name(student_file)
+                self.structure_scores[student] = max(self.structure_scores.get(student, 0), similarities[text_id])
+        print(f"Structure: {len(index)} distinct trees ranked against {len(self.files_gt)} ground truth examples.")
 
     def save_to_csv(self):
         header = ["Student", "Ratio", "Distance", "GT File", "Student File"]
+        if self.first_hit:
+            header.append("Seconds to Solution")
+        if self.structure:
+            header.append("Structure")
         f = open(self.out_file, 'w', newline='')
         writer = csv.writer(f)
         writer.writerow(header)
-        for student_file in self.students:
-            student = os.path.basename(student_file).split(".")[0].split(" ")[-1]
+        for student_file in self.student_files:
+            student = get_student_name(student_file)
             row = [student]
             for el in self.results[student]:
                 if isinstance(el, float):
                     el = round(el, 4)
                 row.append(el)
+            if self.structure:
+                row.append(round(self.structure_scores.get(student, 0), 4))
             writer.writerow(row)
         f.close()
 
@@ -388,24 +1048,120 @@ class TextMatching:
         for value in self.results.values():
             if value[0] == 1:
                 matches += 1
-        print(f"\nFound {matches} exact matches.\n{self.out_file}")
+        print(f"\nFound {matches} exact matches.")
+        if self.max_distance is not None:
+            beyond = sum(1 for value in self.results.values() if value[2] == BEYOND_THRESHOLD)
+            print(f"{beyond} students are beyond the maximum distance of {self.max_distance}.")
+        print(self.out_file)
+
+    def print_cache_stats(self):
+        hits, misses, exact_matches = self.cache_stats
+        comparisons = hits + misses
+        hit_rate = hits / comparisons * 100 if comparisons else 0
+        print(f"Distance cache: {hits} of {comparisons} comparisons reused ({hit_rate:.1f} %), "
+              f"{exact_matches} students matched by hash.")
 
     def run(self):
         self.create_output_folder()
         self.load_ground_truth()
         self.load_project_files()
         self.compare_texts()
+        if self.structure:
+            self.compare_structure()
         self.save_to_csv()
         self.print_exact_matches()
+        if not self.use_index:
+            self.print_cache_stats()
+
+
+FEATURES_FOLDER_NAME = ".features"
+# Features of each snapshot which are aggregated by the DataMiner.
+BLOCK_FEATURES = CATEGORIES + ("All Blocks", "Stacks")
+FEATURE_COLUMNS = ("Time", "Count") + BLOCK_FEATURES
+# Saved tables of another version are extracted again.
+FEATURES_VERSION = 2
+
+
+def get_features_file(student_json):
+    folder, file_name = os.path.split(student_json)
+    return os.path.join(folder, FEATURES_FOLDER_NAME, f"{os.path.splitext(file_name)[0]}.npz")
+
+
+def load_feature_table(student_json):
+    # Returns the features of the student's snapshots as a table indexed by the snapshot file names.
+    # The table is saved by columns in the features folder next to the student files,
+    # with the hash of the blocks of each snapshot. When the student file changes, the saved features
+    # of a snapshot are only reused if both its file name and the hash of its blocks match,
+    # since snapshots whose content changed are parsed again under the same name.
+
+    features_file = get_features_file(student_json)
+    file_stat = os.stat(student_json)
+    source = [file_stat.st_size, file_stat.st_mtime_ns]
+    saved_table = None
+    saved_hashes = dict()
+    if os.path.exists(features_file):
+        with np.load(features_file) as data:
+            if "Version" in data and int(data["Version"]) == FEATURES_VERSION:
+                saved_table = pd.DataFrame({column: data[column] for column in FEATURE_COLUMNS},
+                                           index=data["Snapshot"])
+                if data["Source"].tolist() == source:
+                    return saved_table
+                saved_hashes = dict(zip(data["Snapshot"].tolist(), data["Hash"].tolist()))
+
+    student_project = load_projects(student_json)
+    rows = list()
+    hashes = list()
+    # Snapshots sharing their blocks (deduplicated) or with the same blocks as the previous snapshot
+    # are hashed and classified once.
+    block_data_memo = dict()
+    hash_memo = dict()
+    previous = [None, None]
+    for file_name, project in student_project.items():
+        blocks = project["blocks"]
+        if id(blocks) not in hash_memo:
+            hash_memo[id(blocks)] = project_hash(blocks)
+        blocks_hash = hash_memo[id(blocks)]
+        hashes.append(blocks_hash)
+        if saved_hashes.get(file_name, None) == blocks_hash:
+            rows.append(saved_table.loc[file_name].tolist())
+            continue
+        if id(blocks) in block_data_memo:
+            block_data = block_data_memo[id(blocks)]
+        elif previous[0] is not None and previous[0] == blocks:
+            block_data = previous[1]
+        else:
+            block_data = DataMiner.get_last_block_data(project)
+        block_data_memo[id(blocks)] = block_data
+        previous[:] = [blocks, block_data]
+        rows.append([get_timestamp(file_name), DataMiner.get_count_fast(project)]
+                    + [block_data[key] for key in BLOCK_FEATURES])
+
+    feature_table = pd.DataFrame(rows, index=list(student_project.keys()), columns=FEATURE_COLUMNS)
+    feature_table = feature_table.astype({column: "int64" for column in FEATURE_COLUMNS[1:]})
+    save_feature_table(features_file, feature_table, source, hashes)
+    return feature_table
+
+
+def save_feature_table(features_file, feature_table, source, hashes):
+    # The file is replaced at once, so a failed save doesn't corrupt the table.
+    os.makedirs(os.path.dirname(features_file), exist_ok=True)
+    temp_file = f"{features_file}.tmp"
+    with open(temp_file, 'wb') as f:
+        np.savez(f, Version=np.array(FEATURES_VERSION), Snapshot=np.array(feature_table.index, dtype=str),
+                 Source=np.array(source, dtype="int64"), Hash=np.array(hashes, dtype=str),
+                 **{column: feature_table[column].to_numpy() for column in FEATURE_COLUMNS})
+    os.replace(temp_file, features_file)
 
 
 class DataMiner:
     # Extracts features of the project by each student
     # and saves them in the "info" table.
+    # If processes is set, students are distributed among worker processes
+    # and the rows are saved as soon as all the previous rows are finished, in the order of the input table.
     def __init__(self, _path_projects, _input_csv, _output_folder,
-                 _output_csv, _max_distance, _last_file_only, _header):
+                 _output_csv, _max_distance, _last_file_only, _header, _processes=False, _max_workers=None):
         self.path_projects = _path_projects
-        self.input_csv = os.path.normpath(_input_csv)
+        self.input_csv = os.path.normpath(_input_csv) if _input_csv else None
         self.out_folder = os.path.normpath(_output_folder)
         if not os.path.isdir(self.out_folder):
             os.makedirs(self.out_folder)
@@ -413,6 +1169,8 @@ class DataMiner:
         self.max_distance = _max_distance
         self.last_file_only = _last_file_only
         self.header = _header
+        self.processes = _processes
+        self.max_workers = _max_workers
         if self.input_csv:
             if self.last_file_only:
                 self.last_file_text = "Only classifying blocks from the solution"
@@ -431,68 +1189,77 @@ class DataMiner:
 
     @staticmethod
     def get_last_block_data(file):
+        # The stacks are the children of the root of the tree, top level blocks that are also attached
+        # to another block are detached from the root while the tree is built.
         blocks = file["blocks"]
-        tree, block_parts = tree_builder_fast(blocks)
+        tree, block_parts = tree_builder_array(blocks)
         categorized_blocks = block_classifier(blocks, block_parts)
         count_blocks = sum(categorized_blocks.values())
-        count_programming_stacks = len(tree['root'].children)
+        count_programming_stacks = tree.count_children(0)
         categorized_blocks["All Blocks"] = count_blocks
         categorized_blocks["Stacks"] = count_programming_stacks
         return categorized_blocks
 
-    def get_vector(self, gv_path_pr, gv_student, gv_last_file):
-        removals = 0
-        additions = 0
-        adjustments = 0
+    def get_vector(self, gv_path_pr, gv_student, gv_last_file=None):
+        # Aggregates the features of the student's snapshots up to gv_last_file from the feature table.
+        # If gv_last_file is None, all snapshots are used.
 
-        student_json = os.path.normpath(f"{gv_path_pr}/Lego Spike {gv_student}.json")
+        student_json = get_student_file(gv_path_pr, f"Lego Spike {gv_student}")
         if not os.path.exists(student_json):
             raise Exception("Path does not exist")
-        with open(student_json, 'r', encoding='utf-8') as _f:
-            student_project = json.load(_f)
-
-        file_names_all = list(student_project.keys())
-        last_file_index = file_names_all.index(gv_last_file)
-        file_names = file_names_all[0:last_file_index + 1]
-        if file_names[-1] != gv_last_file:
-            raise Exception("Last file mismatch")
-
-        time_ff = float(file_names[0].split(" ")[0]) / (10 ** 8)
-        time_lf = float(file_names[-1].split(" ")[0]) / (10 ** 8)
-        time_secs = round(time_lf - time_ff)
-
-        for file_name in file_names[0:-1]:
-            file_A = student_project[file_name]
-            next_file_name = file_names[file_names.index(file_name) + 1]
-            file_B = student_project[next_file_name]
-            count_A = self.get_count_fast(file_A)
-            count_B = self.get_count_fast(file_B)
-
-            if count_A > count_B:
-                removals += 1
-            elif count_A < count_B:
-                additions += 1
-            else:
-                adjustments += 1
+        feature_table = load_feature_table(student_json)
+
+        if gv_last_file is None:
+            gv_last_file = feature_table.index[-1]
+        last_file_index = feature_table.index.get_loc(gv_last_file)
+        features = feature_table.iloc[0:last_file_index + 1]
+
+        times = features["Time"].to_numpy()
+        time_secs = round(float(times[-1] - times[0]))
+
+        count_changes = np.diff(features["Count"].to_numpy())
 
         if self.last_file_only:
-            last_file = student_project[file_names[-1]]
-            last_block_data = self.get_last_block_data(last_file)
+            block_data = features[list(BLOCK_FEATURES)].iloc[-1]
         else:
-            last_block_data = self.get_last_block_data(student_project[file_names[0]])
-            for i in range(1, len(file_names)):
-                block_data = self.get_last_block_data(student_project[file_names[i]])
-                for key in last_block_data:
-                    last_block_data[key] += block_data[key]
+            block_data = features[list(BLOCK_FEATURES)].sum()
+        last_block_data = {key: int(block_data[key]) for key in BLOCK_FEATURES}
 
         last_block_data["Steps"] = last_file_index + 1
         last_block_data["Seconds"] = time_secs
-        last_block_data["Additions"] = additions
-        last_block_data["Removals"] = removals
-        last_block_data["Adjustments"] = adjustments
+        last_block_data["Additions"] = int((count_changes > 0).sum())
+        last_block_data["Removals"] = int((count_changes < 0).sum())
+        last_block_data["Adjustments"] = int((count_changes == 0).sum())
+        last_block_data["Student File"] = gv_last_file
 
         return last_block_data
 
+    def get_row(self, student_id, student_file, gt_file):
+        vector = self.get_vector(self.path_projects, student_id, student_file)
+        vector["Student"] = student_id
+        vector["GT File"] = gt_file
+        return [vector[key] for key in self.header]
+
+    def write_rows_processes(self, rows, writer):
+        # Finished rows wait until the previous rows are saved.
+        # As in the serial mode, a student that fails stops the data mining instead of missing in the table.
+        finished_rows = dict()
+        next_row = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_row = {executor.submit(self.get_row, *row): i for i, row in enumerate(rows)}
+            for future in tqdm(concurrent.futures.as_completed(future_to_row), total=len(future_to_row),
+                               bar_format='Getting project data:        {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
+                i = future_to_row[future]
+                try:
+                    finished_rows[i] = future.result()
+                except Exception as exc:
+                    print(f'{rows[i][0]} generated an exception: {exc}')
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+                while next_row in finished_rows:
+                    writer.writerow(finished_rows.pop(next_row))
+                    next_row += 1
+
     def run(self):
 
         # If input_csv is not None
@@ -506,35 +1273,26 @@ class DataMiner:
         else:
             print(f"Using all steps from all students\n{self.last_file_text}\n")
             temp_table = [["Student", "Student File", "GT File"]]
-            all_st = glob.glob(self.path_projects + r"/*.json")
-            for json_file in tqdm(all_st, total=len(all_st),
-                                  bar_format='Creating a temporary table:  {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    lf = sorted(list(json.load(f).keys()))[-1]
+            all_st = sorted(get_projects_files(self.path_projects))
+            for json_file in all_st:
                 st_id = os.path.basename(json_file).split(".")[0].split(" ")[-1]
-                # Student id, last file, GT File replacement
-                temp_table.append([st_id, lf, "All Files"])
+                # Student id, last file (found when the student is loaded), GT File replacement
+                temp_table.append([st_id, None, "All Files"])
             # Set the first row as the header
             corr = pd.DataFrame(temp_table[1:], columns=temp_table[0])
 
         print(f"There are {len(corr.index)} matches.\n")
-        results = list()
-
-        for ind in tqdm(corr.index, total=len(corr.index),
-                        bar_format='Getting project data:        {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
-            student_id = corr['Student'][ind]
-            student_file = corr['Student File'][ind]
-            gt_file = corr['GT File'][ind]
-            vector = self.get_vector(self.path_projects, student_id, student_file)
-            vector["Student"] = student_id
-            vector["Student File"] = student_file
-            vector["GT File"] = gt_file
-            results.append([vector[key] for key in self.header])
+        rows = [(corr['Student'][ind], corr['Student File'][ind], corr['GT File'][ind]) for ind in corr.index]
 
         with open(self.output_csv, 'w', encoding='utf-8', newline='') as f:
             writer = csv.writer(f)
             writer.writerow(self.header)
-            writer.writerows(results)
+            if self.processes:
+                self.write_rows_processes(rows, writer)
+            else:
+                for row in tqdm(rows, total=len(rows),
+                                bar_format='Getting project data:        {l_bar}{bar}|  {n_fmt}/{total_fmt}'):
+                    writer.writerow(self.get_row(*row))
 
         print(f"\nResults: {self.output_csv}")
 
@@ -592,6 +1350,10 @@ class GTParser:
         self.onlykeep.set(True)
         self.checkbox_all_st = tk.BooleanVar()
         self.checkbox_last_only = tk.BooleanVar()
+        self.checkbox_tokens = tk.BooleanVar()
+        self.checkbox_bounded = tk.BooleanVar()
+        self.checkbox_first_hit = tk.BooleanVar()
+        self.checkbox_structure = tk.BooleanVar()
         self.block_parts = dict()
         self.tree = dict()
         self.project = dict()
@@ -696,6 +1458,18 @@ class GTParser:
         checkbox2 = tk.Checkbutton(secondary_window, text="Categorize last data point only",
                                    variable=self.checkbox_last_only)
         checkbox2.pack(anchor="w")
+        checkbox3 = tk.Checkbutton(secondary_window, text="Measure distance in blocks and parameters",
+                                   variable=self.checkbox_tokens)
+        checkbox3.pack(anchor="w")
+        checkbox4 = tk.Checkbutton(secondary_window, text="Compute distances up to maximum distance only",
+                                   variable=self.checkbox_bounded)
+        checkbox4.pack(anchor="w")
+        checkbox5 = tk.Checkbutton(secondary_window, text="Use the first snapshot within maximum distance",
+                                   variable=self.checkbox_first_hit)
+        checkbox5.pack(anchor="w")
+        checkbox6 = tk.Checkbutton(secondary_window, text="Compare the structure of the trees",
+                                   variable=self.checkbox_structure)
+        checkbox6.pack(anchor="w")
         tk.Label(secondary_window, text="Maximum distance:").pack()
         self.entry = tk.Entry(secondary_window)
         self.entry.pack()
@@ -708,6 +1482,11 @@ class GTParser:
     def get_data(self):
         all_st = self.checkbox_all_st.get()
         last_file_only = self.checkbox_last_only.get()
+        metric = METRIC_TOKENS if self.checkbox_tokens.get() else METRIC_CHARACTERS
+        first_hit = self.checkbox_first_hit.get()
+        # The first snapshot within maximum distance is only found with bounded distances.
+        bounded = self.checkbox_bounded.get() or first_hit
+        structure = self.checkbox_structure.get()
         max_distance = 0
 
         try:
@@ -726,7 +1505,10 @@ class GTParser:
             tree_params_name = "Default"
         projects_path = os.path.expanduser(self.paths["projectsdir"])
         out_folder_name = os.path.expanduser(f"{self.paths['treesdir']}/{tree_params_name}")
-        builder = TreeBuilder(projects_path, out_folder_name, tree_params)
+        cache_file = None
+        if self.paths.get("cachedir", None):
+            cache_file = os.path.expanduser(f"{self.paths['cachedir']}/trees.sqlite")
+        builder = TreeBuilder(projects_path, out_folder_name, tree_params, cache_file, _processes=True)
         builder.create_trees()
 
         print("\nFinding distances...")
@@ -738,7 +1520,11 @@ class GTParser:
         path_trees = os.path.expanduser(f"{self.paths['treesdir']}/{gt_name}")
         out_folder = os.path.expanduser(self.paths['distancesdir'])
         dist_out_file = os.path.expanduser(f"{self.paths['distancesdir']}/Distances {gt_name}.csv")
-        text_matching = TextMatching(gt_json, path_trees, out_folder, dist_out_file)
+        # If bounded, the nearest snapshot is the one with the smallest distance within the maximum distance,
+        # otherwise the one with the largest ratio. All students are used with the unbounded distances.
+        text_matching = TextMatching(gt_json, path_trees, out_folder, dist_out_file, _processes=True,
+                                     _max_distance=max_distance if bounded and not all_st else None, _metric=metric,
+                                     _structure=structure, _first_hit=first_hit)
         text_matching.run()
 
         print("\nGetting data...")
@@ -764,7 +1550,8 @@ class GTParser:
                   "Operators", "Sensors", "Sound", "Variables",
                   "All Blocks", "Stacks", "Seconds")
 
-        checker = DataMiner(projects_path, input_csv, output_folder, output_csv, max_distance, last_file_only, header)
+        checker = DataMiner(projects_path, input_csv, output_folder, output_csv, max_distance, last_file_only, header,
+                            _processes=True)
         checker.run()
 
     def text_window_refresh(self):
@@ -0,0 +1,93 @@
+# Micro-benchmarks of the performance-critical functions.
+# Expects a folder containing project snapshots (.llsp or .llsp3), searched recursively,
+# given as the first argument or chosen in a dialog.
+# Results are checked against the reference implementations.
+
+import glob
+import sys
+import tracemalloc
+from time import perf_counter
+
+from assess_task import tree_builder_fast, tree_visualizer, tree_builder_array, tree_visualizer_array
+from cf import directory_dialog, get_project, get_project_full
+
+
+def time_function(function, items, repeat=3):
+    # Returns the best total time of calling the function for all of the items.
+
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for item in items:
+            function(item)
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_get_project(llsp_files):
+    for llsp_file in llsp_files:
+        if get_project(llsp_file) != get_project_full(llsp_file):
+            raise Exception(f"Fast extraction mismatch: {llsp_file}")
+
+    time_full = time_function(get_project_full, llsp_files)
+    time_fast = time_function(get_project, llsp_files)
+    print(f"Project extraction ({len(llsp_files)} snapshots):")
+    print(f"  get_project_full: {time_full / len(llsp_files) * 1000:.3f} ms per snapshot")
+    print(f"  get_project:      {time_fast / len(llsp_files) * 1000:.3f} ms per snapshot")
+    print(f"  Speedup:          {time_full / time_fast:.2f}x\n")
+
+
+def peak_memory(function, items):
+    # Returns the largest peak of the memory allocated while calling the function for one of the items.
+
+    peak = 0
+    for item in items:
+        tracemalloc.start()
+        function(item)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peak
+
+
+def render_anytree(blocks):
+    tree, block_parts = tree_builder_fast(blocks)
+    return tree_visualizer(blocks, block_parts, tree, None)
+
+
+def render_array(blocks):
+    tree, block_parts = tree_builder_array(blocks)
+    return tree_visualizer_array(blocks, block_parts, tree, None)
+
+
+def benchmark_trees(llsp_files):
+    all_blocks = [get_project(llsp_file)["blocks"] for llsp_file in llsp_files]
+    for blocks, llsp_file in zip(all_blocks, llsp_files):
+        if render_anytree(blocks) != render_array(blocks):
+            raise Exception(f"Tree text mismatch: {llsp_file}")
+
+    time_anytree = time_function(render_anytree, all_blocks)
+    time_array = time_function(render_array, all_blocks)
+    memory_anytree = peak_memory(render_anytree, all_blocks)
+    memory_array = peak_memory(render_array, all_blocks)
+    print(f"Tree building and rendering ({len(all_blocks)} snapshots, "
+          f"up to {max(len(blocks) for blocks in all_blocks)} blocks):")
+    print(f"  anytree:     {time_anytree / len(all_blocks) * 1000:.3f} ms per snapshot, "
+          f"peak {memory_anytree / 1024:.1f} KiB")
+    print(f"  array tree:  {time_array / len(all_blocks) * 1000:.3f} ms per snapshot, "
+          f"peak {memory_array / 1024:.1f} KiB")
+    print(f"  Speedup:     {time_anytree / time_array:.2f}x, memory {memory_anytree / memory_array:.2f}x less\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = directory_dialog(title="Choose the folder with project snapshots")
+    files = (list(glob.glob(f"{path}/**/*.llsp", recursive=True))
+             + list(glob.glob(f"{path}/**/*.llsp3", recursive=True)))
+    if not files:
+        raise Exception("No snapshots found")
+    benchmark_get_project(sorted(files))
+    benchmark_trees(sorted(files))
@@ -1,17 +1,44 @@
 # Functions used by the main programs.
 
 from math import sqrt
+import hashlib
 import zipfile
 import json
 import io
+import os
+import re
+import struct
+import zlib
 import yaml
 import tkinter
 from tkinter.filedialog import askdirectory
 
+# Extension of the members of snapshots stored as references in the collector archives.
+ARCHIVE_REFERENCE_EXTENSION = ".ref"
+
 
 def get_project(llsp_file):
     # Extracts blocks, broadcasts, lists and variables from the project json file.
     # Blocks are filtered for the observed attributes.
+    # Fast path: a stored (uncompressed) scratch.sb3 is opened in place instead of being copied,
+    # and only the first two targets of the project json file are parsed,
+    # skipping the other targets, monitors, extensions and meta data.
+
+    with zipfile.ZipFile(llsp_file, 'r') as zfile_outer:
+        scratch = open_archive_member(zfile_outer, zfile_outer.getinfo("scratch.sb3"))
+        with zipfile.ZipFile(scratch, 'r') as zfile_inner:
+            project_json = zfile_inner.read("project.json")
+
+    targets = get_first_targets(project_json.decode("utf-8"))
+    if targets is None:
+        targets = json.loads(project_json)["targets"]
+
+    return trim_project(targets)
+
+
+def get_project_full(llsp_file):
+    # Reference implementation of get_project, which copies scratch.sb3
+    # and parses the whole project json file. Used for benchmarking.
 
     with zipfile.ZipFile(llsp_file, 'r') as zfile_outer:
         scratch = io.BytesIO(zfile_outer.read("scratch.sb3"))
@@ -20,18 +47,24 @@ def get_project(llsp_file):
 
     project = json.loads(project_json.decode("utf-8"))
 
-    blocks = project["targets"][0]["blocks"]
-    blocks.update(project["targets"][1]["blocks"])
+    return trim_project(project["targets"])
+
+
+def trim_project(targets):
+    # Merges the stage (first target) and the sprite (second target).
+
+    blocks = targets[0]["blocks"]
+    blocks.update(targets[1]["blocks"])
     blocks_filtered = filter_attributes(blocks)
 
-    variables = project["targets"][0]["variables"]
-    variables.update(project["targets"][1]["variables"])
+    variables = targets[0]["variables"]
+    variables.update(targets[1]["variables"])
 
-    lists = project["targets"][0]["lists"]
-    lists.update(project["targets"][1]["lists"])
+    lists = targets[0]["lists"]
+    lists.update(targets[1]["lists"])
 
-    broadcasts = project["targets"][0]["broadcasts"]
-    broadcasts.update(project["targets"][1]["broadcasts"])
+    broadcasts = targets[0]["broadcasts"]
+    broadcasts.update(targets[1]["broadcasts"])
 
     project_trimmed = dict()
     project_trimmed["blocks"] = blocks_filtered
@@ -42,6 +75,169 @@ def get_project(llsp_file):
     return project_trimmed
 
 
+TARGETS_START = re.compile(r'\s*\{\s*"targets"\s*:\s*\[\s*')
+COMMA = re.compile(r'\s*,\s*')
+json_decoder = json.JSONDecoder()
+
+
+def get_first_targets(project_text):
+    # Parses only the first two targets of the project json text.
+    # Returns None if the text doesn't start with the targets, which are then parsed as a whole.
+
+    match = TARGETS_START.match(project_text)
+    if not match:
+        return None
+    try:
+        target_0, end = json_decoder.raw_decode(project_text, match.end())
+        match = COMMA.match(project_text, end)
+        if not match:
+            return None
+        target_1, _ = json_decoder.raw_decode(project_text, match.end())
+    except ValueError:
+        return None
+    return [target_0, target_1]
+
+
+def open_archive_member(zfile, info):
+    # Returns a seekable file object of an archive member.
+    # Stored (uncompressed) members are read in place, others are decompressed into memory.
+
+    if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+        return FileWindow(zfile.fp, get_member_offset(zfile, info), info.file_size)
+    return io.BytesIO(zfile.read(info))
+
+
+def read_archive_references(zfile):
+    # Returns the snapshots of a collector archive that are stored as references to an identical earlier snapshot,
+    # as a dictionary of their member names and the names of the members with the content.
+
+    references = dict()
+    for info in zfile.infolist():
+        if info.filename.endswith(ARCHIVE_REFERENCE_EXTENSION):
+            references[info.filename[:-len(ARCHIVE_REFERENCE_EXTENSION)]] = zfile.read(info).decode("utf-8")
+    return references
+
+
+def read_local_headers(archive_file):
+    # Returns the names, offsets and fields of the local headers of the members of a zip file,
+    # read without its directory, up to the first member that doesn't fit into the file.
+    # The collector appends the snapshots to its archive as stored members with their sizes in the local headers,
+    # None is returned for other members.
+
+    headers = list()
+    with open(archive_file, 'rb') as f:
+        size = f.seek(0, io.SEEK_END)
+        offset = 0
+        while offset + zipfile.sizeFileHeader <= size:
+            f.seek(offset)
+            header = f.read(zipfile.sizeFileHeader)
+            if header[:4] != zipfile.stringFileHeader:
+                break
+            fields = struct.unpack(zipfile.structFileHeader, header)
+            flag_bits, compress_type, compressed_size = fields[3], fields[4], fields[8]
+            if flag_bits & 0x8 or compress_type != zipfile.ZIP_STORED:
+                return None
+            name_length, extra_length = fields[10:12]
+            name = f.read(name_length).decode("utf-8" if flag_bits & 0x800 else "cp437")
+            end = offset + zipfile.sizeFileHeader + name_length + extra_length + compressed_size
+            if end > size:
+                break
+            headers.append((name, offset, fields))
+            offset = end
+    return headers
+
+
+def archive_needs_recovery(archive_file):
+    # Returns True if the directory of a collector archive doesn't match the local headers of its members,
+    # i.e. the collector was stopped while appending a snapshot.
+    # The snapshots are zip files themselves, so the directory of the last stored snapshot
+    # can be found instead of the overwritten directory of the archive.
+
+    headers = read_local_headers(archive_file)
+    if not headers:
+        return False
+    try:
+        with zipfile.ZipFile(archive_file, 'r') as zfile:
+            directory = [(info.filename, info.header_offset) for info in zfile.infolist()]
+    except zipfile.BadZipFile:
+        return True
+    return directory != [(name, offset) for name, offset, _ in headers]
+
+
+def recover_archive(archive_file):
+    # Rebuilds the directory of a collector archive from the complete members in its local headers,
+    # the interrupted member is dropped. The archive is replaced at once.
+    # Returns the number of recovered members.
+
+    members = list()
+    with open(archive_file, 'rb') as f:
+        for name, offset, fields in read_local_headers(archive_file):
+            mod_time, mod_date, crc, compressed_size = fields[5:9]
+            name_length, extra_length = fields[10:12]
+            f.seek(offset + zipfile.sizeFileHeader + name_length + extra_length)
+            content = f.read(compressed_size)
+            if zlib.crc32(content) != crc:
+                break
+            info = zipfile.ZipInfo(name, ((mod_date >> 9) + 1980, (mod_date >> 5) & 0xF, mod_date & 0x1F,
+                                          mod_time >> 11, (mod_time >> 5) & 0x3F, (mod_time & 0x1F) * 2))
+            members.append((info, content))
+
+    temp_file = f"{archive_file}.tmp"
+    with zipfile.ZipFile(temp_file, 'w') as zfile:
+        for info, content in members:
+            zfile.writestr(info, content)
+    os.replace(temp_file, archive_file)
+    return len(members)
+
+
+def get_member_offset(zfile, info):
+    # Returns the offset of the data of a zip archive member.
+
+    zfile.fp.seek(info.header_offset)
+    header = zfile.fp.read(zipfile.sizeFileHeader)
+    if header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header of {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+class FileWindow(io.RawIOBase):
+    # Read-only view of a part of a file, used to open a stored archive member in place.
+    def __init__(self, _f, _start, _size):
+        super().__init__()
+        self.f = _f
+        self.start = _start
+        self.size = _size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, size=-1):
+        remaining = max(self.size - self.position, 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        self.f.seek(self.start + self.position)
+        data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+
 def filter_attributes(blocks):
     # Extracts the observed attributes of a block.
 
@@ -126,6 +322,45 @@ def flatten_list_fast(lst):
                 yield i
 
 
+def file_hash(file_path, chunk_size=1 << 20):
+    # Returns the SHA-256 hash of the file content.
+
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def project_hash(project):
+    # Returns the SHA-256 hash of the canonical json form of a parsed project.
+
+    project_json = json.dumps(project, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(project_json.encode("utf-8")).hexdigest()
+
+
+def get_timestamp(file_name):
+    # Returns the time of a snapshot in seconds, taken from the file name.
+
+    return float(file_name.split(" ")[0]) / (10 ** 8)
+
+
+def is_reference(project):
+    # Deduplicated snapshots are stored as {"ref": file name of the identical snapshot}.
+
+    return "ref" in project and "blocks" not in project
+
+
+def resolve_references(projects):
+    # Replaces references to identical snapshots with the referenced projects.
+
+    for file_name, project in projects.items():
+        while is_reference(project):
+            project = projects[project["ref"]]
+        projects[file_name] = project
+    return projects
+
+
 def directory_dialog(title='Choose the directory:'):
     root = tkinter.Tk()
     root.withdraw()
@@ -8,18 +8,36 @@
 # The output path where all the snapshots are archived
 # into a zip file is defined as snapshots_path
 # in the main part of the program.
+# Snapshots are appended to the zip file as they are
+# collected, so the zip file is complete at any time.
+# If the tool was killed while appending a snapshot,
+# the zip file is repaired at the next start.
 
 # Spike modifies all the project files in its directory
 # at every start, therefore, those files will also be
 # included if this tool is started before Spike.
 # For some changes, Spike modifies the file multiple times,
-# twice for example for block removals.
-
-
+# twice for example for block removals. Such bursts are
+# debounced and only the final content is collected.
+
+# Live scoring: if a ground truth file of a task is given as an argument,
+# the snapshots are scored against it while they are collected and the
+# distance of each project to the nearest ground truth example is shown.
+# The parameters of the task are read from the file of the same name
+# with the .yml extension, if it exists.
+# Usage: collect_snapshots.py [ground truth json]
+
+
+from hashlib import blake2b
+import io
+import json
+import os
+from queue import Queue, Empty, Full
+import sys
 from subprocess import Popen
 from pathlib import Path
-from time import time, sleep
-from shutil import copyfile
+from threading import Lock, Thread
+from time import time, sleep, perf_counter
 from zipfile import ZipFile
 from random import choice
 from string import ascii_lowercase
@@ -29,6 +47,12 @@ from watchdog.observers import Observer
 from tkinter import Tk, Button, Label, StringVar
 from tkinter.filedialog import askdirectory
 
+from cf import ARCHIVE_REFERENCE_EXTENSION, archive_needs_recovery, get_params, get_project, recover_archive
+
+DEBOUNCE_SECONDS = 0.25
+CAPTURE_QUEUE_SIZE = 1024
+LIVE_QUEUE_SIZE = 64
+
 
 def zero_fill(in_s):
     # Insert zeros at the end of a string
@@ -56,23 +80,123 @@ def directory_dialog():
     return dd
 
 
-def file_accessible(fp):
-    # Check if file can be accessed.
-    fa = False
-    try:
-        with open(fp):
-            fa = True
-    except:
-        pass
-    return fa
+def recover_archives(snapshots_path):
+    # Repairs the zip files left by a collector that was killed while appending a snapshot.
+    for archive_path in snapshots_path.glob("Lego Spike *.zip"):
+        if archive_needs_recovery(archive_path):
+            print(f"Recovered {recover_archive(archive_path)} snapshots of {archive_path.name}")
+
+
+class SnapshotArchive:
+    # Zip file of the snapshots, written while they are collected.
+    # Each snapshot is appended as a stored member named "<timestamp> <project>.llsp3",
+    # and the zip file is closed and synced to the disk after every snapshot.
+    # A snapshot identical to an earlier one (e.g. after undoing changes) is stored once:
+    # its member has ARCHIVE_REFERENCE_EXTENSION appended to the name
+    # and contains the name of the member with the content.
+    def __init__(self, _archive_path):
+        self.archive_path = _archive_path
+        # Content hash -> name of the member with the content
+        self.members = dict()
+        self.references = 0
+        with ZipFile(self.archive_path, mode="w"):
+            pass
+
+    def append(self, member_name, content, content_hash):
+        with open(self.archive_path, 'r+b') as f:
+            with ZipFile(f, mode="a") as archive:
+                if content_hash in self.members:
+                    archive.writestr(member_name + ARCHIVE_REFERENCE_EXTENSION, self.members[content_hash])
+                    self.references += 1
+                else:
+                    archive.writestr(member_name, content)
+                    self.members[content_hash] = member_name
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class LiveScorer(Thread):
+    # Scores the collected snapshots against the ground truth examples in a background thread.
+    # The watchdog thread only puts the snapshots into a queue and never waits for the scoring.
+    # Snapshots queued while others are scored are coalesced, only the latest snapshot of a project is scored.
+    def __init__(self, _gt_file, _queue_size=LIVE_QUEUE_SIZE):
+        super().__init__(daemon=True)
+        # The assessment module is only needed for live scoring.
+        from assess_task import DistanceCache, nearest_snapshot, tree_builder_array, tree_visualizer_array
+
+        self.tree_builder = tree_builder_array
+        self.tree_visualizer = tree_visualizer_array
+        self.nearest_snapshot = nearest_snapshot
+
+        with open(_gt_file, 'r', encoding='utf-8') as f:
+            files_gt = json.load(f)
+        # The ground truth texts are hashed once and the distances of repeated trees are reused.
+        self.cache = DistanceCache(files_gt)
+        self.cleanup, self.onlykeep, self.flexible = False, None, None
+        params_file = Path(_gt_file).with_suffix(".yml")
+        if params_file.is_file():
+            self.cleanup, self.onlykeep, self.flexible = get_params(params_file)
+
+        self.queue = Queue(maxsize=_queue_size)
+        self.lock = Lock()
+        # Project name -> (distance, ground truth name, seconds from the capture to the score)
+        self.scores = dict()
+        self.dropped = 0
+
+    def submit(self, project_name, snapshot_name, content):
+        # A full queue drops the snapshot instead of waiting.
+        try:
+            self.queue.put_nowait((project_name, snapshot_name, content, perf_counter()))
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            latest = dict()
+            project_name, *snapshot = self.queue.get()
+            latest[project_name] = snapshot
+            while True:
+                try:
+                    project_name, *snapshot = self.queue.get_nowait()
+                except Empty:
+                    break
+                latest[project_name] = snapshot
+            for project_name, (snapshot_name, content, captured) in latest.items():
+                self.score(project_name, snapshot_name, content, captured)
+
+    def score(self, project_name, snapshot_name, content, captured):
+        try:
+            blocks = get_project(io.BytesIO(content))["blocks"]
+            tree, block_parts = self.tree_builder(blocks, self.cleanup, self.onlykeep)
+            text = self.tree_visualizer(blocks, block_parts, tree, self.flexible)
+            _, distance, gt_name, _ = self.nearest_snapshot({snapshot_name: text}, self.cache)
+        except Exception as e:
+            print(f"Error scoring {snapshot_name}:\n{e}")
+            return
+        with self.lock:
+            self.scores[project_name] = (distance, gt_name, perf_counter() - captured)
+
+    def get_scores(self):
+        with self.lock:
+            return dict(self.scores)
 
 
 class MyHandler(FileSystemEventHandler):
+    # The watchdog thread only hands the modify events to a capture thread through a bounded queue.
+    # Bursts of events of a file are debounced: the file is read once it hasn't been modified for
+    # DEBOUNCE_SECONDS, and it is archived only if its content differs from the last snapshot of the same file.
+    # A file that can't be read yet (e.g. still open in Spike) is retried after another DEBOUNCE_SECONDS.
 
-    def __init__(self, _snapshots_path):
+    def __init__(self, _archive, _scorer=None):
         self.counter = 0
-        self.file_prev = None
-        self.snapshots_path = _snapshots_path
+        self.dropped = 0
+        self.archive = _archive
+        self.scorer = _scorer
+        # File path -> hash of the content of its last snapshot
+        self.file_hashes = dict()
+        self.events = Queue(maxsize=CAPTURE_QUEUE_SIZE)
+        self.capture_thread = Thread(target=self.capture, daemon=True)
+        self.capture_thread.start()
 
     def on_modified(self, event):
         # When a file is modified
@@ -80,31 +204,86 @@ class MyHandler(FileSystemEventHandler):
         file_extension = file_path.suffix
 
         if file_extension == ".llsp" or file_extension == ".llsp3":
-
-            file_name = file_path.stem
-
-            while not file_accessible(file_path):
-                # Wait until file is closed
-                sleep(0.01)
-
+            try:
+                self.events.put_nowait((file_path, time()))
+            except Full:
+                self.dropped += 1
+
+    def stop(self):
+        # Captures the pending files and stops the capture thread.
+        self.events.put(None)
+        self.capture_thread.join()
+
+    def capture(self):
+        # File path -> (time of the last modify event, time to read the file)
+        pending = dict()
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(due for _, due in pending.values()) - time())
+            try:
+                event = self.events.get(timeout=timeout)
+            except Empty:
+                event = ()
+            if event is None:
+                for file_path, (modified, _) in pending.items():
+                    self.take_snapshot(file_path, modified)
+                return
+            if event:
+                file_path, modified = event
+                pending[file_path] = (modified, modified + DEBOUNCE_SECONDS)
+            # Due files are captured after every event, so the events of one file don't delay the others.
+            now = time()
+            for file_path, (modified, due) in list(pending.items()):
+                if due > now:
+                    continue
+                if self.take_snapshot(file_path, modified):
+                    del pending[file_path]
+                else:
+                    pending[file_path] = (modified, now + DEBOUNCE_SECONDS)
+
+    def take_snapshot(self, file_path, modified):
+        # Returns False if the file can't be read yet.
+        try:
             with open(file_path, 'rb') as f:
                 file_curr = f.read()
-
-            if file_curr != self.file_prev:
-                self.counter += 1
-                self.file_prev = file_curr
-                tstamp = zero_fill(str(time()).replace('.', ''))
-                copyfile(file_path, self.snapshots_path / str(tstamp + " " + file_name + file_extension))
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+
+        file_hash = blake2b(file_curr).digest()
+        if file_hash != self.file_hashes.get(file_path, None):
+            self.file_hashes[file_path] = file_hash
+            tstamp = zero_fill(str(modified).replace('.', ''))
+            snapshot_name = str(tstamp + " " + file_path.stem + file_path.suffix)
+            try:
+                self.archive.append(snapshot_name, file_curr, file_hash)
+            except OSError as e:
+                print(f"Error archiving {snapshot_name}:\n{e}")
+                return False
+            self.counter += 1
+            if self.scorer:
+                self.scorer.submit(file_path.stem, snapshot_name, file_curr)
+        return True
 
 
 class GUI:
-    def __init__(self, _snapshots_path, _open_when_finished):
+    def __init__(self, _snapshots_path, _open_when_finished, _gt_file=None):
 
         self.snapshots_path = _snapshots_path
         self.open_when_finished = _open_when_finished
-        self.zipfile_full_path = None
         default_dir = Path.expanduser(Path('~/Documents/LEGO Education SPIKE'))
-        self.event_handler = MyHandler(_snapshots_path=self.snapshots_path)
+        self.scorer = None
+        if _gt_file:
+            self.scorer = LiveScorer(_gt_file)
+            self.scorer.start()
+        self.snapshots_path.mkdir(parents=True, exist_ok=True)
+        recover_archives(self.snapshots_path)
+        zipfile_name = "Lego Spike " + random_string(16) + ".zip"
+        self.zipfile_full_path = self.snapshots_path / zipfile_name
+        self.archive = SnapshotArchive(self.zipfile_full_path)
+        self.event_handler = MyHandler(_archive=self.archive, _scorer=self.scorer)
         self.observer = Observer()  # Watchdog
         if Path.is_dir(default_dir):
             directory = default_dir
@@ -112,8 +291,6 @@ class GUI:
             # If the working directory was not found
             directory = Path(directory_dialog())
 
-        self.subfolder = self.snapshots_path
-        self.subfolder.mkdir(parents=True, exist_ok=True)
         self.observer.schedule(self.event_handler, str(directory), recursive=False)
         self.observer.start()
 
@@ -125,6 +302,12 @@ class GUI:
         instruction = " "*10 + "*** Please do not close this window ***" + " "*10
         Label(self.root, text=instruction).pack()
         Label(self.root, textvariable=self.txt_var).pack()
+        # Events dropped by a full queue, a dropped last event of a file loses that save.
+        self.dropped_var = StringVar()
+        Label(self.root, textvariable=self.dropped_var).pack()
+        self.scores_var = StringVar()
+        if self.scorer:
+            Label(self.root, textvariable=self.scores_var, justify="left").pack()
         Label(self.root, text="").pack()
         Button(self.root, text="Collect snapshots", command=self.make_callback("exit")).pack()
         Label(self.root, text="").pack()
@@ -140,27 +323,37 @@ class GUI:
         while not self.settings["exit"]:
             sleep(0.05)
             self.txt_var.set("Snapshots count: " + str(self.event_handler.counter))
+            self.dropped_var.set(self.dropped_text())
+            if self.scorer:
+                self.scores_var.set(self.scores_text())
             self.root.update()
 
         self.observer.stop()
         self.observer.join()
+        self.event_handler.stop()
         self.root.destroy()
         self.root.quit()
 
-        llsp_files = list(self.subfolder.glob('*.llsp')) + list(self.subfolder.glob('*.llsp3'))
-        zipfile_name = "Lego Spike " + random_string(16) + ".zip"
-        self.zipfile_full_path = self.subfolder / zipfile_name
-        with ZipFile(self.zipfile_full_path, mode="a") as archive:
-            for file in llsp_files:
-                archive.write(filename=file, arcname=file.name)
-
         if self.open_when_finished:
             Popen(f'explorer /select,"{self.zipfile_full_path}"')
 
+    def dropped_text(self):
+        text = "Dropped events: " + str(self.event_handler.dropped)
+        if self.scorer:
+            text += ", dropped from scoring: " + str(self.scorer.dropped)
+        return text
+
+    def scores_text(self):
+        lines = list()
+        for project_name, (distance, gt_name, latency) in sorted(self.scorer.get_scores().items()):
+            lines.append(f"{project_name}: distance {distance} to {gt_name} ({latency:.2f} s)")
+        return "\n".join(lines) if lines else "Waiting for a snapshot to score"
+
 
 if __name__ == "__main__":
     # "snapshots" folder in the current directory
     snapshots_path = Path().absolute() / "snapshots"
     open_when_finished = True
-    g = GUI(snapshots_path, open_when_finished)
+    gt_file = sys.argv[1] if len(sys.argv) > 1 else None
+    g = GUI(snapshots_path, open_when_finished, gt_file)
     g.main()
@@ -0,0 +1,159 @@
+# Structural similarity of the trees based on pq-grams.
+# A pq-gram of a tree is a node with its p - 1 ancestors and q consecutive children,
+# the missing ancestors and children are filled with NULL_LABEL.
+# The pq-gram distance of two trees, 1 - 2 |common pq-grams| / (|pq-grams 1| + |pq-grams 2|),
+# approximates the tree edit distance and is computed in linear time in the size of the trees.
+# An inverted index of the pq-grams of all snapshots ranks every snapshot against a ground truth example
+# in a single pass over the postings of the example's pq-grams.
+#
+# Nodes are labeled with the block opcode and parameters, as in the textual trees.
+# The parts of a block (e.g. the condition of an if block) are its first children.
+# Trees are read from their text (text_tree), as saved in the trees folder.
+#
+# Usage: pq_grams.py <trees folder> <ground truth json> [number of snapshots to show]
+
+from collections import Counter
+import glob
+import json
+import os
+import sys
+from tkinter.filedialog import askopenfilename
+
+from cf import directory_dialog
+
+P = 2
+Q = 3
+NULL_LABEL = "*"
+
+
+def text_tree(text):
+    # Converts a textual tree into lists of node labels and node children, node 0 is the root.
+
+    labels = ["root"]
+    children = [[]]
+    # Nodes of the current branch by depth.
+    branch = [0]
+    for line in text.split("\n")[2:]:
+        if not line:
+            continue
+        content = line.lstrip("│├└─ ")
+        depth = (len(line) - len(content)) // 4
+        items = content.split(" | ")
+        node = len(labels)
+        labels.append(items[0])
+        children.append([])
+        del branch[depth:]
+        children[branch[-1]].append(node)
+        branch.append(node)
+        for item in items[1:]:
+            children[node].append(len(labels))
+            labels.append(item)
+            children.append([])
+    return labels, children
+
+
+def pq_gram_profile(labels, children, p=P, q=Q):
+    # Returns the bag of pq-grams of a tree.
+
+    profile = Counter()
+    nodes = [(0, (NULL_LABEL,) * p)]
+    while nodes:
+        node, ancestors = nodes.pop()
+        ancestors = ancestors[1:] + (labels[node],)
+        node_children = children[node]
+        if not node_children:
+            profile[ancestors + (NULL_LABEL,) * q] += 1
+            continue
+        siblings = (NULL_LABEL,) * q
+        for child in node_children:
+            siblings = siblings[1:] + (labels[child],)
+            profile[ancestors + siblings] += 1
+            nodes.append((child, ancestors))
+        for _ in range(q - 1):
+            siblings = siblings[1:] + (NULL_LABEL,)
+            profile[ancestors + siblings] += 1
+    return profile
+
+
+def pq_gram_distance(profile_a, profile_b):
+    common = sum((profile_a & profile_b).values())
+    return 1 - 2 * common / (sum(profile_a.values()) + sum(profile_b.values()))
+
+
+class PQGramIndex:
+    # Inverted index of the pq-grams of distinct textual trees.
+    def __init__(self):
+        self.ids = dict()
+        self.sizes = list()
+        # pq-gram -> list of (text ID, count)
+        self.postings = dict()
+        # Texts of the loaded trees folder: text ID -> list of (student file, snapshot file)
+        self.occurrences = dict()
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def insert(self, text):
+        # Returns the ID of the text, identical texts are indexed once.
+        if text in self.ids:
+            return self.ids[text]
+        text_id = len(self.sizes)
+        profile = pq_gram_profile(*text_tree(text))
+        for pq_gram, count in profile.items():
+            self.postings.setdefault(pq_gram, list()).append((text_id, count))
+        self.sizes.append(sum(profile.values()))
+        self.ids[text] = text_id
+        return text_id
+
+    def add_trees(self, trees_folder):
+        # Indexes the texts of all student files in the trees folder and records where they occur.
+        for student_file in sorted(glob.glob(f"{trees_folder}/*.json")):
+            with open(student_file, 'r', encoding='utf-8') as f:
+                student_texts = json.load(f)
+            for snapshot_file, text in student_texts.items():
+                text_id = self.insert(text)
+                self.occurrences.setdefault(text_id, list()).append((student_file, snapshot_file))
+
+    def distances(self, text):
+        # Returns the pq-gram distances of all indexed texts to the text, by text ID.
+        profile = pq_gram_profile(*text_tree(text))
+        size = sum(profile.values())
+        common = [0] * len(self.sizes)
+        for pq_gram, count in profile.items():
+            for text_id, text_count in self.postings.get(pq_gram, ()):
+                common[text_id] += min(count, text_count)
+        return [1 - 2 * common[text_id] / (size + self.sizes[text_id]) for text_id in range(len(self.sizes))]
+
+    def rank(self, text):
+        # Returns the distances and IDs of the indexed texts, nearest first.
+        return sorted((distance, text_id) for text_id, distance in enumerate(self.distances(text)))
+
+
+def load_index(trees_folder):
+    index = PQGramIndex()
+    index.add_trees(trees_folder)
+    return index
+
+
+def print_ranking(index, files_gt, limit):
+    for gt_name, gt_text in files_gt.items():
+        print(f"\n{gt_name}:")
+        shown = 0
+        for distance, text_id in index.rank(gt_text):
+            for student_file, snapshot_file in index.occurrences.get(text_id, list()):
+                print(f"  {1 - distance:.4f}\t{os.path.basename(student_file)}\t{snapshot_file}")
+                shown += 1
+            if shown >= limit:
+                break
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        path_trees, path_gt = sys.argv[1], sys.argv[2]
+    else:
+        path_trees = directory_dialog(title="Choose the trees folder")
+        path_gt = askopenfilename(title="Choose the ground truth file", filetypes=[("Ground truth", "*.json")])
+    snapshots_limit = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    with open(path_gt, 'r', encoding='utf-8') as gt_file:
+        gt_texts = json.load(gt_file)
+    print_ranking(load_index(path_trees), gt_texts, snapshots_limit)
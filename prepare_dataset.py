@@ -1,20 +1,137 @@
-from cf import get_paths, directory_dialog, get_project
+from cf import (get_paths, directory_dialog, get_project, file_hash, project_hash, get_timestamp,
+                open_archive_member, read_archive_references, archive_needs_recovery, recover_archive)
 import glob
 import json
 import os
+import time
+import zipfile
 from tqdm import tqdm
 import concurrent.futures
+import itertools
+from project_store import STORE_EXTENSION, save_store, load_projects
+
+
+def get_student_projects(llsp_files, archive=None):
+    # Parses all snapshots of a single student.
+    # If archive is given, the snapshots are read from the archive, llsp_files are then "archive path/member name".
+    # Snapshots stored as references in the archive are read from the members they refer to.
+    # Used as a work unit by the process pool, therefore defined at module level.
+
+    projects = dict()
+    if archive:
+        with zipfile.ZipFile(archive, 'r') as zfile:
+            references = read_archive_references(zfile)
+            for llsp_file in llsp_files:
+                try:
+                    member_name = llsp_file[len(archive) + 1:]
+                    info = zfile.getinfo(references.get(member_name, member_name))
+                    with open_archive_member(zfile, info) as member:
+                        projects[os.path.basename(member_name)] = get_project(member)
+                except Exception as exc:
+                    print(f'{llsp_file} generated an exception: {exc}')
+        return projects
+
+    for llsp_file in llsp_files:
+        try:
+            projects[os.path.basename(llsp_file)] = get_project(llsp_file)
+        except Exception as exc:
+            print(f'{llsp_file} generated an exception: {exc}')
+    return projects
+
+
+def deduplicate_projects(projects, dedup=None, coalesce_seconds=None):
+    # Collapses redundant snapshots of a single student, as Spike saves a project several times for some edits.
+    # Projects are expected to be sorted by file name, i.e. by time.
+    # coalesce_seconds: a snapshot followed by another one within the time window is dropped.
+    # dedup "drop": a snapshot identical to the previous one is dropped.
+    # dedup "link": a snapshot identical to any earlier one is replaced by a reference to it,
+    # which keeps the number of steps in the timeline.
+    # Returns the remaining projects and a dictionary of collapsed file names and the kept file names.
+
+    collapsed = dict()
+    file_names = list(projects.keys())
+
+    if coalesce_seconds:
+        kept_file_names = list()
+        for file_name, next_file_name in zip(file_names, file_names[1:]):
+            if get_timestamp(next_file_name) - get_timestamp(file_name) <= coalesce_seconds:
+                collapsed[file_name] = next_file_name
+            else:
+                kept_file_names.append(file_name)
+        kept_file_names += file_names[-1:]
+        file_names = kept_file_names
+
+    out_projects = dict()
+    first_file_name = dict()
+    previous_hash = None
+    previous_file_name = None
+    for file_name in file_names:
+        project = projects[file_name]
+        if dedup:
+            current_hash = project_hash(project)
+            if dedup == "drop" and current_hash == previous_hash:
+                collapsed[file_name] = previous_file_name
+                continue
+            if dedup == "link" and current_hash in first_file_name:
+                collapsed[file_name] = first_file_name[current_hash]
+                project = {"ref": first_file_name[current_hash]}
+            else:
+                first_file_name[current_hash] = file_name
+            previous_hash = current_hash
+            previous_file_name = file_name
+        out_projects[file_name] = project
+
+    # Collapsed snapshots point to the snapshot that remains, e.g. the last one of a burst.
+    for file_name, kept_file_name in collapsed.items():
+        while kept_file_name in collapsed:
+            kept_file_name = collapsed[kept_file_name]
+        collapsed[file_name] = kept_file_name
+
+    return out_projects, collapsed
 
 
 class LLSPProcessor:
-    # Expects folder containing folders named after student IDs containing their snapshots.
+    # Expects folder containing folders named after student IDs containing their snapshots,
+    # or zip files created by the collector, which are read without extraction.
+    # Student IDs of the zip files are their names without the extension.
     # The snapshots will be parsed into json files for fast assessment and feature collection.
-    def __init__(self, _path, _out_folder_name):
+    # If processes is set, the snapshots are parsed in a process pool with one work unit per student,
+    # otherwise in a thread pool with one work unit per file.
+    # If incremental is set, only new or changed snapshots are parsed and merged into the existing
+    # student files. Parsed snapshots are recorded in a manifest in the output folder.
+    # Redundant snapshots are collapsed according to dedup and coalesce_seconds (see deduplicate_projects)
+    # and the collapsed file names are recorded in the output folder.
+    # If streaming is set, each student file is saved as soon as the student is parsed and
+    # only the students in progress are kept in memory (one per worker).
+    # Student files are saved as json files, or as compact store files if store_format is "store".
+    # Store files are delta encoded with a full snapshot every keyframe_interval snapshots.
+    def __init__(self, _path, _out_folder_name, _processes=False, _max_workers=None, _incremental=False,
+                 _dedup=None, _coalesce_seconds=None, _streaming=False, _store_format="json",
+                 _keyframe_interval=None):
         self.path = _path
         self.folders_all = glob.glob(f'{_path}/*/')
         self.folders = []
+        self.archives_all = glob.glob(f'{_path}/*.zip')
+        self.archives = {}
+        self.archive_infos = {}
+        self.folder_files = {}
         self.projects = {}
         self.out_folder = os.path.normpath(_out_folder_name)
+        self.processes = _processes
+        self.max_workers = _max_workers
+        self.incremental = _incremental
+        # Hidden file, therefore not matched by the *.json globs of the other programs.
+        self.manifest_file = os.path.join(self.out_folder, ".manifest.json")
+        self.manifest = {}
+        self.dedup = _dedup
+        self.coalesce_seconds = _coalesce_seconds
+        self.collapsed_file = os.path.join(self.out_folder, ".collapsed.json")
+        self.collapsed = {}
+        self.streaming = _streaming
+        # Names of the parsed files per student, recorded once the student file is saved.
+        self.saved_files = {}
+        self.store_format = _store_format
+        self.keyframe_interval = _keyframe_interval
 
     def process_folders(self):
         for folder in self.folders_all:
@@ -23,6 +140,117 @@ class LLSPProcessor:
                 first_file_extension = os.path.basename(folder_files[0]).split(".")[-1]
                 if first_file_extension in ("llsp", "llsp3"):
                     self.folders.append(folder)
+        folder_names = set(os.path.basename(os.path.normpath(folder)) for folder in self.folders)
+        for archive in self.archives_all:
+            folder_name = os.path.splitext(os.path.basename(archive))[0]
+            if folder_name in folder_names:
+                print(f"Skipping {archive}, already extracted.")
+            else:
+                self.archives[folder_name] = archive
+
+    def collect_files(self):
+        for folder in self.folders:
+            folder_name = os.path.basename(os.path.normpath(folder))
+            self.folder_files[folder_name] = self.get_folder_files(folder)
+        for folder_name, archive in self.archives.items():
+            # An archive of a collector that was stopped while appending a snapshot is repaired first.
+            if archive_needs_recovery(archive):
+                print(f"Recovered {recover_archive(archive)} snapshots of {archive}, "
+                      f"the collector was stopped while appending a snapshot.")
+            try:
+                with zipfile.ZipFile(archive, 'r') as zfile:
+                    infos = {f"{archive}/{info.filename}": info for info in zfile.infolist()
+                             if info.filename.split(".")[-1] in ("llsp", "llsp3")}
+                    # Snapshots stored as references have the size and the hash of the member they refer to.
+                    for member_name, content_name in read_archive_references(zfile).items():
+                        if member_name.split(".")[-1] in ("llsp", "llsp3"):
+                            infos[f"{archive}/{member_name}"] = zfile.getinfo(content_name)
+            except zipfile.BadZipFile as exc:
+                print(f"Skipping {archive}, it can't be read: {exc}")
+                continue
+            if infos:
+                self.archive_infos.update(infos)
+                self.folder_files[folder_name] = list(infos.keys())
+            else:
+                print(f"Skipping {archive}, it contains no snapshots.")
+
+    @staticmethod
+    def get_folder_files(folder):
+        return list(glob.glob(f"{folder}/*.llsp")) + list(glob.glob(f"{folder}/*.llsp3"))
+
+    def get_out_file(self, folder_name, store_format=None):
+        if (store_format or self.store_format) == "store":
+            return f"{self.out_folder}/{folder_name}{STORE_EXTENSION}"
+        return f"{self.out_folder}/{folder_name}.json"
+
+    def get_other_out_file(self, folder_name):
+        # Student file of the format that is not used.
+        return self.get_out_file(folder_name, "json" if self.store_format == "store" else "store")
+
+    def load_manifest(self):
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+
+    def save_manifest(self):
+        # Parsed files are added to the manifest only after their student file was saved.
+        for folder_name, file_names in self.saved_files.items():
+            for file in self.folder_files[folder_name]:
+                if os.path.basename(file) in file_names:
+                    self.manifest[os.path.abspath(file)] = self.get_file_record(file)
+        temp_file = f"{self.manifest_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(temp_file, self.manifest_file)
+
+    def get_file_stat(self, file):
+        # Returns the size and the modification time of a file or an archive member.
+        if file in self.archive_infos:
+            info = self.archive_infos[file]
+            return info.file_size, time.mktime(info.date_time + (0, 0, -1))
+        stat = os.stat(file)
+        return stat.st_size, stat.st_mtime
+
+    def get_file_hash(self, file):
+        if file in self.archive_infos:
+            # CRC-32 of the member content from the archive directory, the member is not read.
+            return f"{self.archive_infos[file].CRC:08x}"
+        return file_hash(file)
+
+    def get_file_record(self, file):
+        size, mtime = self.get_file_stat(file)
+        return {"size": size, "mtime": mtime, "hash": self.get_file_hash(file)}
+
+    def is_file_unchanged(self, file):
+        record = self.manifest.get(os.path.abspath(file), None)
+        if not record:
+            return False
+        size, mtime = self.get_file_stat(file)
+        if size == record["size"] and mtime == record["mtime"]:
+            return True
+        # The file was touched, the content decides.
+        if size == record["size"] and self.get_file_hash(file) == record["hash"]:
+            self.manifest[os.path.abspath(file)]["mtime"] = mtime
+            return True
+        return False
+
+    def skip_unchanged_files(self):
+        skipped = 0
+        for folder_name in list(self.folder_files.keys()):
+            if not os.path.isfile(self.get_out_file(folder_name)):
+                # Student file is missing or saved in the other format, all of the snapshots are parsed again.
+                continue
+            changed_files = []
+            for file in self.folder_files[folder_name]:
+                if self.is_file_unchanged(file):
+                    skipped += 1
+                else:
+                    changed_files.append(file)
+            if changed_files:
+                self.folder_files[folder_name] = changed_files
+            else:
+                del self.folder_files[folder_name]
+        print(f"Skipping {skipped} unchanged files.")
 
     @staticmethod
     def get_project_with_tqdm(llsp_file, pbar):
@@ -31,11 +259,12 @@ class LLSPProcessor:
         return project
 
     def process_files(self):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             # Create a list of file paths to process
             llsp_files = []
-            for folder in self.folders:
-                llsp_files += list(glob.glob(f"{folder}/*.llsp")) + list(glob.glob(f"{folder}/*.llsp3"))
+            for folder_name, files in self.folder_files.items():
+                if folder_name not in self.archives:
+                    llsp_files += files
             # Create a dictionary to store the future objects
             with tqdm(total=len(llsp_files),
                       bar_format='Processing files:  {l_bar}{bar}|  {n_fmt}/{total_fmt}') as pbar:
@@ -53,16 +282,115 @@ class LLSPProcessor:
                     except Exception as exc:
                         print(f'{file} generated an exception: {exc}')
 
+                # Archives are read as a whole by a single worker.
+                future_to_folder = {executor.submit(get_student_projects, self.folder_files[folder_name], archive):
+                                    folder_name for folder_name, archive in self.archives.items()
+                                    if folder_name in self.folder_files}
+                pbar.total += sum(len(self.folder_files[folder_name]) for folder_name in future_to_folder.values())
+                pbar.refresh()
+                for future in concurrent.futures.as_completed(future_to_folder):
+                    folder_name = future_to_folder[future]
+                    try:
+                        projects = future.result()
+                        if projects:
+                            self.projects[folder_name] = projects
+                    except Exception as exc:
+                        print(f'{folder_name} generated an exception: {exc}')
+                    pbar.update(len(self.folder_files[folder_name]))
+
+    def process_students(self):
+        # Each student's folder is parsed in a separate process, which avoids the GIL.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            with tqdm(total=sum(len(files) for files in self.folder_files.values()),
+                      bar_format='Processing files:  {l_bar}{bar}|  {n_fmt}/{total_fmt}') as pbar:
+                future_to_folder = {executor.submit(get_student_projects, files, self.archives.get(folder_name)):
+                                    folder_name for folder_name, files in self.folder_files.items()}
+                for future in concurrent.futures.as_completed(future_to_folder):
+                    folder_name = future_to_folder[future]
+                    try:
+                        projects = future.result()
+                        if projects:
+                            self.projects[folder_name] = projects
+                    except Exception as exc:
+                        print(f'{folder_name} generated an exception: {exc}')
+                    pbar.update(len(self.folder_files[folder_name]))
+
+    def process_students_streaming(self):
+        # A new student is submitted only when a previous one was saved,
+        # which bounds the memory by the largest students in progress.
+        if self.processes:
+            executor_class = concurrent.futures.ProcessPoolExecutor
+        else:
+            executor_class = concurrent.futures.ThreadPoolExecutor
+        max_workers = self.max_workers or os.cpu_count() or 1
+        folders = iter(self.folder_files.items())
+        with executor_class(max_workers=max_workers) as executor:
+            with tqdm(total=sum(len(files) for files in self.folder_files.values()),
+                      bar_format='Processing files:  {l_bar}{bar}|  {n_fmt}/{total_fmt}') as pbar:
+                future_to_folder = {executor.submit(get_student_projects, files, self.archives.get(folder_name)):
+                                    folder_name for folder_name, files in itertools.islice(folders, max_workers)}
+                while future_to_folder:
+                    done, _ = concurrent.futures.wait(future_to_folder,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        folder_name = future_to_folder.pop(future)
+                        try:
+                            projects = future.result()
+                            if projects:
+                                self.projects[folder_name] = projects
+                                self.save_folder_output(folder_name)
+                        except Exception as exc:
+                            print(f'{folder_name} generated an exception: {exc}')
+                        self.projects.pop(folder_name, None)
+                        pbar.update(len(self.folder_files[folder_name]))
+                        for next_folder_name, files in itertools.islice(folders, 1):
+                            future = executor.submit(get_student_projects, files, self.archives.get(next_folder_name))
+                            future_to_folder[future] = next_folder_name
+
     def create_output_folder(self):
         if not os.path.isdir(self.out_folder):
             os.makedirs(self.out_folder)
 
     def save_folder_output(self, folder_name):
-        out_file = f"{self.out_folder}/{folder_name}.json"
-        sorted_primary_keys = sorted(list(self.projects[folder_name].keys()))
-        primary_sorted_project = {key: self.projects[folder_name][key] for key in sorted_primary_keys}
-        with open(out_file, 'w', encoding='utf-8') as f:
-            json.dump(primary_sorted_project, f, indent=2)
+        out_file = self.get_out_file(folder_name)
+        other_out_file = self.get_other_out_file(folder_name)
+        projects = self.projects[folder_name]
+        if self.incremental:
+            for existing_file in (out_file, other_out_file):
+                if os.path.isfile(existing_file):
+                    # Merge the new snapshots into the existing student file. References are resolved first,
+                    # as a new snapshot may replace the content of a referenced one,
+                    # and built again from the merged snapshots by deduplicate_projects.
+                    existing_projects = load_projects(existing_file)
+                    existing_projects.update(projects)
+                    projects = existing_projects
+                    break
+        sorted_primary_keys = sorted(list(projects.keys()))
+        primary_sorted_project = {key: projects[key] for key in sorted_primary_keys}
+        if self.dedup or self.coalesce_seconds:
+            primary_sorted_project, collapsed = deduplicate_projects(primary_sorted_project, self.dedup,
+                                                                     self.coalesce_seconds)
+            if self.incremental:
+                # The collapsed snapshots of a student are computed again from the merged student file,
+                # which doesn't contain the snapshots dropped by earlier runs. Their records are kept
+                # and point to the snapshot that remains, which may have been collapsed in this run.
+                previous_collapsed = self.collapsed.get(folder_name, {})
+                merged_collapsed = {file_name: collapsed.get(kept_file_name, kept_file_name)
+                                    for file_name, kept_file_name in previous_collapsed.items()
+                                    if file_name not in projects}
+                merged_collapsed.update(collapsed)
+                collapsed = merged_collapsed
+            # Also recorded if empty, so that saved records of the student are updated.
+            self.collapsed[folder_name] = collapsed
+        if self.store_format == "store":
+            save_store(out_file, primary_sorted_project, self.keyframe_interval)
+        else:
+            with open(out_file, 'w', encoding='utf-8') as f:
+                json.dump(primary_sorted_project, f, indent=2)
+        if os.path.isfile(other_out_file):
+            # Only one file per student, otherwise the student would be assessed twice.
+            os.remove(other_out_file)
+        self.saved_files[folder_name] = set(self.projects[folder_name].keys())
 
     def save_output(self):
         with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -76,17 +404,51 @@ class LLSPProcessor:
                 except Exception as exc:
                     print(f'{folder} generated an exception: {exc}')
 
+    def load_collapsed(self):
+        if os.path.isfile(self.collapsed_file):
+            with open(self.collapsed_file, 'r', encoding='utf-8') as f:
+                self.collapsed = json.load(f)
+
+    def save_collapsed(self):
+        collapsed = dict()
+        if os.path.isfile(self.collapsed_file):
+            with open(self.collapsed_file, 'r', encoding='utf-8') as f:
+                collapsed = json.load(f)
+        for folder_name, folder_collapsed in self.collapsed.items():
+            collapsed[folder_name] = folder_collapsed
+        with open(self.collapsed_file, 'w', encoding='utf-8') as f:
+            json.dump(collapsed, f, indent=2, sort_keys=True)
+        count = sum(len(self.collapsed[folder_name]) for folder_name in self.saved_files)
+        print(f"Collapsed {count} redundant snapshots.")
+
     def run(self):
         self.create_output_folder()
         self.process_folders()
-        self.process_files()
-        self.save_output()
+        self.collect_files()
+        if self.incremental:
+            self.load_manifest()
+            if self.dedup or self.coalesce_seconds:
+                self.load_collapsed()
+            self.skip_unchanged_files()
+        if self.streaming:
+            self.process_students_streaming()
+        elif self.processes:
+            self.process_students()
+            self.save_output()
+        else:
+            self.process_files()
+            self.save_output()
+        if self.dedup or self.coalesce_seconds:
+            self.save_collapsed()
+        if self.incremental:
+            self.save_manifest()
         print(f"\nDone.\nOutput path: {self.out_folder}")
 
 
 if __name__ == "__main__":
     paths = get_paths(r"paths.yml")
-    path = directory_dialog(title="Choose the folder with project snapshots sorted into folders by ID")
+    path = directory_dialog(title="Choose the folder with the collected zip files or snapshots sorted into folders by ID")
     out_folder_name = os.path.expanduser(paths["projectsdir"])
-    processor = LLSPProcessor(path, out_folder_name)
+    processor = LLSPProcessor(path, out_folder_name, _processes=True, _incremental=True,
+                              _dedup="link", _streaming=True)
     processor.run()
@@ -0,0 +1,246 @@
+# Compact binary store for the student files in the projects folder.
+# Each snapshot is saved as a separately compressed json record,
+# and an index of the snapshot file names and record offsets is saved at the end of the file,
+# so that a single snapshot or a range of snapshots can be read without parsing the rest.
+# Optionally, the timeline is delta encoded: a full snapshot (keyframe) is saved every keyframe_interval
+# snapshots and the snapshots in between are saved as added, removed and modified blocks,
+# variables, lists and broadcasts with respect to the previous snapshot.
+#
+# Layout:
+#   header: magic, version, reserved bytes, index offset (uint64)
+#   records: zlib compressed json, one per snapshot
+#   index: zlib compressed json list of [file name, offset, length, kind], sorted by file name (time),
+#          kind is FULL_RECORD or DELTA_RECORD (version 1 has no kinds, all records are full)
+
+from bisect import bisect_left, bisect_right
+import glob
+import json
+import os
+import struct
+import zlib
+
+from cf import get_timestamp, is_reference, resolve_references
+
+STORE_EXTENSION = ".spks"
+STORE_MAGIC = b"SPKS"
+STORE_VERSION = 2
+STORE_VERSIONS = (1, 2)
+HEADER_FORMAT = "<4sB3xQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+FULL_RECORD = 0
+DELTA_RECORD = 1
+
+
+def is_delta_compatible(project):
+    # Projects consist of dictionaries (blocks, broadcasts, lists, variables),
+    # references to identical snapshots are saved as full records.
+
+    return (isinstance(project, dict) and not is_reference(project)
+            and all(isinstance(section, dict) for section in project.values()))
+
+
+def project_delta(previous, current):
+    # Returns the added, removed and modified items of each section of the project.
+
+    delta = dict()
+    for section_name in set(previous.keys()) | set(current.keys()):
+        previous_section = previous.get(section_name, dict())
+        current_section = current.get(section_name, dict())
+        section_delta = dict()
+        added = {key: value for key, value in current_section.items() if key not in previous_section}
+        removed = [key for key in previous_section if key not in current_section]
+        modified = {key: value for key, value in current_section.items()
+                    if key in previous_section and previous_section[key] != value}
+        if added:
+            section_delta["add"] = added
+        if removed:
+            section_delta["remove"] = removed
+        if modified:
+            section_delta["modify"] = modified
+        if section_delta:
+            delta[section_name] = section_delta
+    return delta
+
+
+def apply_delta(previous, delta):
+    # Returns a new project, unchanged items are shared with the previous project.
+
+    project = dict(previous)
+    for section_name, section_delta in delta.items():
+        section = dict(previous.get(section_name, dict()))
+        for key in section_delta.get("remove", list()):
+            del section[key]
+        section.update(section_delta.get("add", dict()))
+        section.update(section_delta.get("modify", dict()))
+        project[section_name] = section
+    return project
+
+
+def save_store(store_file, projects, keyframe_interval=None):
+    # Saves a dictionary of snapshots as a store file.
+    # If keyframe_interval is larger than 1, the snapshots are delta encoded.
+    # The file is replaced at once, so readers never see a partially written store.
+
+    temp_file = f"{store_file}.tmp"
+    index = list()
+    previous = None
+    deltas = 0
+    with open(temp_file, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, STORE_MAGIC, STORE_VERSION, 0))
+        for file_name in sorted(projects.keys()):
+            project = projects[file_name]
+            kind = FULL_RECORD
+            record = zlib.compress(json.dumps(project, separators=(',', ':')).encode("utf-8"))
+            if is_reference(project):
+                # The delta of the next snapshot is based on the referenced snapshot.
+                resolved = projects[project["ref"]]
+                while is_reference(resolved):
+                    resolved = projects[resolved["ref"]]
+            else:
+                resolved = project
+                if (keyframe_interval and keyframe_interval > 1 and deltas < keyframe_interval - 1
+                        and previous is not None and is_delta_compatible(previous)
+                        and is_delta_compatible(project)):
+                    delta = project_delta(previous, project)
+                    delta_record = zlib.compress(json.dumps(delta, separators=(',', ':')).encode("utf-8"))
+                    # Rewritten projects are saved as keyframes.
+                    if len(delta_record) < len(record):
+                        record = delta_record
+                        kind = DELTA_RECORD
+                if kind == DELTA_RECORD:
+                    deltas += 1
+                else:
+                    deltas = 0
+            previous = resolved
+            index.append([file_name, f.tell(), len(record), kind])
+            f.write(record)
+        index_offset = f.tell()
+        f.write(zlib.compress(json.dumps(index, separators=(',', ':')).encode("utf-8")))
+        f.seek(0)
+        f.write(struct.pack(HEADER_FORMAT, STORE_MAGIC, STORE_VERSION, index_offset))
+    os.replace(temp_file, store_file)
+
+
+class ProjectStore:
+    # Random access reader of a store file.
+    def __init__(self, _store_file):
+        self.store_file = _store_file
+        self.f = open(self.store_file, 'rb')
+        magic, version, index_offset = struct.unpack(HEADER_FORMAT, self.f.read(HEADER_SIZE))
+        if magic != STORE_MAGIC or version not in STORE_VERSIONS:
+            self.f.close()
+            raise Exception(f"Invalid store file: {self.store_file}")
+        self.f.seek(index_offset)
+        self.index = json.loads(zlib.decompress(self.f.read()).decode("utf-8"))
+        self.file_names = [entry[0] for entry in self.index]
+        self.positions = {entry[0]: i for i, entry in enumerate(self.index)}
+        self.kinds = [entry[3] if len(entry) > 3 else FULL_RECORD for entry in self.index]
+        self.timestamps = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.f.close()
+
+    def keys(self):
+        return list(self.file_names)
+
+    def read_record(self, position):
+        offset, length = self.index[position][1:3]
+        self.f.seek(offset)
+        return json.loads(zlib.decompress(self.f.read(length)).decode("utf-8"))
+
+    def get(self, file_name, resolve=True):
+        position = self.positions[file_name]
+        if self.kinds[position] == DELTA_RECORD:
+            return next(self.iter_snapshots(position, position + 1))[1]
+        project = self.read_record(position)
+        while resolve and is_reference(project):
+            project = self.get(project["ref"])
+        return project
+
+    def snapshot(self, n, resolve=True):
+        # Returns the file name and the content of the n-th snapshot.
+        file_name = self.file_names[n]
+        return file_name, self.get(file_name, resolve)
+
+    def iter_snapshots(self, start=0, stop=None, resolve=True):
+        # Yields the file names and the contents of the snapshots from start to stop (exclusive) in order.
+        # Delta encoded snapshots are reconstructed from the nearest keyframe,
+        # therefore the yielded snapshots share unchanged items and should not be modified.
+        positions = range(len(self.index))[start:stop]
+        if not positions:
+            return
+        position = positions.start
+        while self.kinds[position] == DELTA_RECORD:
+            position -= 1
+        previous = None
+        for position in range(position, positions.stop):
+            project = self.read_record(position)
+            if self.kinds[position] == DELTA_RECORD:
+                project = apply_delta(previous, project)
+                previous = project
+            elif is_reference(project):
+                previous = self.get(project["ref"])
+                if resolve:
+                    project = previous
+            else:
+                previous = project
+            if position >= positions.start:
+                yield self.file_names[position], project
+
+    def get_range(self, start=0, stop=None, resolve=True):
+        # Returns the snapshots from start to stop (exclusive) by position as a dictionary.
+        return dict(self.iter_snapshots(start, stop, resolve))
+
+    def time_range(self, start_time=None, end_time=None, resolve=True):
+        # Returns the snapshots taken between start_time and end_time (inclusive) in seconds.
+        if self.timestamps is None:
+            self.timestamps = [get_timestamp(file_name) for file_name in self.file_names]
+        start = 0 if start_time is None else bisect_left(self.timestamps, start_time)
+        stop = len(self.index) if end_time is None else bisect_right(self.timestamps, end_time)
+        return self.get_range(start, stop, resolve)
+
+
+def is_store(projects_file):
+    return projects_file.endswith(STORE_EXTENSION)
+
+
+def get_projects_files(projects_folder):
+    # Student files of both formats in the projects folder.
+
+    return glob.glob(f"{projects_folder}/*.json") + glob.glob(f"{projects_folder}/*{STORE_EXTENSION}")
+
+
+def get_student_file(projects_folder, student_name):
+    # Returns the student file of either format, json by default.
+
+    store_file = os.path.normpath(f"{projects_folder}/{student_name}{STORE_EXTENSION}")
+    if os.path.exists(store_file):
+        return store_file
+    return os.path.normpath(f"{projects_folder}/{student_name}.json")
+
+
+def load_projects(projects_file, resolve=True, last_file_name=None):
+    # Loads a student file of either format.
+    # If last_file_name is given, a store file is only read up to that snapshot.
+
+    if is_store(projects_file):
+        with ProjectStore(projects_file) as store:
+            stop = None
+            if last_file_name in store.positions:
+                stop = store.positions[last_file_name] + 1
+            return store.get_range(0, stop, resolve)
+
+    with open(projects_file, 'r', encoding='utf-8') as f:
+        projects = json.load(f)
+    if resolve:
+        projects = resolve_references(projects)
+    return projects
@@ -0,0 +1,170 @@
+# Metric index of the distinct textual trees in a trees folder.
+# The texts are kept in a BK-tree under the Levenshtein distance: each child of a text is saved under
+# its distance to the text, so by the triangle inequality only the children whose distance differs
+# from the distance of the query by at most the searched distance have to be visited.
+# Range queries ("all trees within distance k of a ground truth example") and nearest neighbour queries
+# therefore compare the query to a fraction of the distinct texts.
+# The index is saved in the trees folder and updated with the new texts when the trees change,
+# so new ground truth examples can be matched without comparing them to every snapshot.
+#
+# Usage: text_index.py <trees folder> <ground truth json> [maximum distance]
+
+import glob
+import json
+import os
+import sys
+import zlib
+from tkinter.filedialog import askopenfilename
+
+import Levenshtein
+
+from cf import directory_dialog
+
+INDEX_FILE_NAME = ".text_index.bkt"
+INDEX_VERSION = 1
+
+
+class TextIndex:
+    # BK-tree of distinct texts, the first text is the root.
+    def __init__(self, _index_file=None):
+        self.index_file = _index_file
+        self.texts = list()
+        self.children = list()
+        self.ids = dict()
+        # Texts of the loaded trees folder: text ID -> list of (student file, snapshot file)
+        self.occurrences = dict()
+        self.comparisons = 0
+        if self.index_file and os.path.exists(self.index_file):
+            self.load()
+
+    def __len__(self):
+        return len(self.texts)
+
+    def load(self):
+        with open(self.index_file, 'rb') as f:
+            data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        if data.get("version", None) != INDEX_VERSION:
+            raise Exception(f"Invalid index file: {self.index_file}")
+        self.texts = data["texts"]
+        self.children = [{distance: child for distance, child in node_children} for node_children in data["children"]]
+        self.ids = {text: text_id for text_id, text in enumerate(self.texts)}
+
+    def save(self):
+        # The file is replaced at once, so a failed save doesn't corrupt the index.
+        data = {"version": INDEX_VERSION, "texts": self.texts,
+                "children": [sorted(node_children.items()) for node_children in self.children]}
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(zlib.compress(json.dumps(data, separators=(',', ':')).encode("utf-8")))
+        os.replace(temp_file, self.index_file)
+
+    def distance(self, text_a, text_b):
+        self.comparisons += 1
+        return Levenshtein.distance(text_a, text_b)
+
+    def insert(self, text):
+        # Returns the ID of the text, identical texts are saved once.
+        if text in self.ids:
+            return self.ids[text]
+        text_id = len(self.texts)
+        self.texts.append(text)
+        self.children.append(dict())
+        self.ids[text] = text_id
+        node = 0
+        while text_id:
+            distance = self.distance(text, self.texts[node])
+            child = self.children[node].get(distance, None)
+            if child is None:
+                self.children[node][distance] = text_id
+                break
+            node = child
+        return text_id
+
+    def add_trees(self, trees_folder):
+        # Inserts the texts of all student files in the trees folder and records where they occur.
+        self.occurrences = dict()
+        for student_file in sorted(glob.glob(f"{trees_folder}/*.json")):
+            with open(student_file, 'r', encoding='utf-8') as f:
+                student_texts = json.load(f)
+            for snapshot_file, text in student_texts.items():
+                text_id = self.insert(text)
+                self.occurrences.setdefault(text_id, list()).append((student_file, snapshot_file))
+
+    def range_query(self, query, max_distance):
+        # Returns the IDs and distances of the texts within max_distance of the query.
+        if not self.texts:
+            return dict()
+        found = dict()
+        nodes = [0]
+        while nodes:
+            node = nodes.pop()
+            distance = self.distance(query, self.texts[node])
+            if distance <= max_distance:
+                found[node] = distance
+            for child_distance, child in self.children[node].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+    def nearest(self, query, max_distance=None):
+        # Returns the distance and the ID of the nearest text,
+        # or None if there is no text within max_distance.
+        best = None
+        best_distance = float("inf") if max_distance is None else max_distance + 1
+        nodes = [0] if self.texts else list()
+        while nodes:
+            node = nodes.pop()
+            distance = self.distance(query, self.texts[node])
+            if distance < best_distance:
+                best_distance = distance
+                best = node
+            # The children closest to the distance of the query are visited first.
+            candidates = [(abs(child_distance - distance), child)
+                          for child_distance, child in self.children[node].items()
+                          if abs(child_distance - distance) < best_distance]
+            nodes.extend(child for _, child in sorted(candidates, reverse=True))
+        if best is None:
+            return None
+        return best_distance, best
+
+
+def load_index(trees_folder):
+    # Returns the updated index of a trees folder, new texts are inserted and the index is saved.
+    index = TextIndex(os.path.normpath(f"{trees_folder}/{INDEX_FILE_NAME}"))
+    texts = len(index)
+    index.add_trees(trees_folder)
+    if len(index) != texts:
+        index.save()
+    return index
+
+
+def print_matches(index, files_gt, max_distance):
+    for gt_name, gt_text in files_gt.items():
+        comparisons = index.comparisons
+        found = index.range_query(gt_text, max_distance)
+        nearest = index.nearest(gt_text)
+        comparisons = index.comparisons - comparisons
+        snapshots = sum(len(index.occurrences.get(text_id, list())) for text_id in found)
+        print(f"\n{gt_name}: {len(found)} distinct trees ({snapshots} snapshots) within distance {max_distance}, "
+              f"{comparisons} comparisons for {len(index)} distinct trees.")
+        if nearest:
+            distance, text_id = nearest
+            student_files = sorted(set(os.path.basename(student_file)
+                                       for student_file, _ in index.occurrences.get(text_id, list())))
+            print(f"Nearest tree at distance {distance}: {', '.join(student_files)}")
+        for text_id, distance in sorted(found.items(), key=lambda item: (item[1], item[0])):
+            for student_file, snapshot_file in index.occurrences.get(text_id, list()):
+                print(f"  {distance}\t{os.path.basename(student_file)}\t{snapshot_file}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        path_trees, path_gt = sys.argv[1], sys.argv[2]
+    else:
+        path_trees = directory_dialog(title="Choose the trees folder")
+        path_gt = askopenfilename(title="Choose the ground truth file", filetypes=[("Ground truth", "*.json")])
+    distance_limit = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    with open(path_gt, 'r', encoding='utf-8') as gt_file:
+        gt_texts = json.load(gt_file)
+    text_index = load_index(path_trees)
+    print_matches(text_index, gt_texts, distance_limit)
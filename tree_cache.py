@@ -0,0 +1,110 @@
+# Persistent cache of the textual trees created by the TreeBuilder.
+# Trees are keyed by the hash of the snapshot blocks and the hash of the effective parameters,
+# so repeated assessments and parameter experiments only create the trees that were not created before.
+# The least recently used trees are evicted when the cache exceeds its maximum size.
+
+import hashlib
+import json
+import os
+import sqlite3
+from time import time
+
+from cf import project_hash
+
+DEFAULT_CACHE_SIZE = 256 * 1024 ** 2  # Bytes
+
+
+def params_hash(cleanup, onlykeep, flexible):
+    # The order of the opcodes in onlykeep and flexible doesn't affect the trees.
+
+    params = [bool(cleanup), sorted(onlykeep) if onlykeep else None, sorted(flexible) if flexible else None]
+    return hashlib.sha256(json.dumps(params).encode("utf-8")).hexdigest()
+
+
+def tree_key(blocks, parameters_hash):
+    return f"{parameters_hash}:{project_hash(blocks)}"
+
+
+class TreeCache:
+    # A connection to the cache, which should be used by a single thread.
+    # New trees and usage times are buffered and written at once by commit, so no write transaction is open
+    # while trees are created. Workers hand their updates to a single writer (take_updates and add_updates).
+    def __init__(self, _cache_file, _max_size=DEFAULT_CACHE_SIZE):
+        self.cache_file = _cache_file
+        self.max_size = _max_size
+        cache_folder = os.path.dirname(self.cache_file)
+        if cache_folder and not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder, exist_ok=True)
+        self.connection = sqlite3.connect(self.cache_file, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS trees "
+                                "(key TEXT PRIMARY KEY, tree TEXT, size INTEGER, used REAL)")
+        self.used_keys = list()
+        self.new_trees = list()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, key):
+        row = self.connection.execute("SELECT tree FROM trees WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used_keys.append(key)
+        return row[0]
+
+    def put(self, key, tree):
+        self.new_trees.append((key, tree))
+
+    def take_updates(self):
+        # Returns and clears the buffered new trees and the keys of the hits.
+        updates = self.new_trees, self.used_keys
+        self.new_trees = list()
+        self.used_keys = list()
+        return updates
+
+    def add_updates(self, new_trees, used_keys):
+        self.new_trees += new_trees
+        self.used_keys += used_keys
+
+    def commit(self):
+        # New trees are inserted and usage times of the hits are updated in a single short transaction.
+        if not self.new_trees and not self.used_keys:
+            return
+        now = time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?)",
+                                        ((key, tree, len(tree), now) for key, tree in self.new_trees))
+            self.connection.executemany("UPDATE trees SET used = ? WHERE key = ?",
+                                        ((now, key) for key in self.used_keys))
+        self.new_trees = list()
+        self.used_keys = list()
+
+    def evict(self):
+        # Removes the least recently used trees until the cache is 10 % below its maximum size.
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM trees").fetchone()[0]
+        if total_size <= self.max_size:
+            return 0
+        evicted = 0
+        target_size = self.max_size * 0.9
+        rows = self.connection.execute("SELECT key, size FROM trees ORDER BY used").fetchall()
+        evicted_keys = list()
+        for key, size in rows:
+            if total_size <= target_size:
+                break
+            evicted_keys.append((key,))
+            total_size -= size
+            evicted += 1
+        self.connection.executemany("DELETE FROM trees WHERE key = ?", evicted_keys)
+        self.connection.commit()
+        return evicted
+
+    def close(self):
+        self.commit()
+        self.connection.close()